@@ -0,0 +1,54 @@
+// Search the index written by smcl2html.py --search-index (see smcl_search.py)
+//
+// Usage:
+//     smclSearch('search/', 'robust vce').then(function (results) { ... });
+// Each result is {page, title, score}, best first; a page must contain all
+// the words searched for. Shards are only fetched for the words searched for,
+// and are kept for the following searches.
+
+var smclSearch = (function () {
+    var loaded = {};
+
+    function load(url) {
+        if (!(url in loaded)) {
+            loaded[url] = fetch(url).then(function (response) {
+                return response.ok ? response.json() : {};
+            });
+        }
+        return loaded[url];
+    }
+
+    function terms(query) {
+        var stopWords = ['the', 'and', 'of', 'to', 'is', 'are', 'be', 'that', 'this', 'an'];
+        return (query.toLowerCase().match(/[a-z0-9_]{2,}/g) || []).filter(function (term, i, all) {
+            return stopWords.indexOf(term) < 0 && !/^[0-9]+$/.test(term) && all.indexOf(term) === i;
+        });
+    }
+
+    return function (base, query) {
+        var words = terms(query);
+        var shards = words.map(function (term) {
+            return load(base + 'terms-' + term.slice(0, 2) + '.json');
+        });
+        return Promise.all([load(base + 'docs.json')].concat(shards)).then(function (data) {
+            var docs = data[0];
+            var scores = null;
+            words.forEach(function (term, i) {
+                var found = {};
+                (data[i + 1][term] || []).forEach(function (posting) {
+                    if (scores === null || posting[0] in scores) {
+                        found[posting[0]] = (scores === null ? 0 : scores[posting[0]]) + posting[1];
+                    }
+                });
+                scores = found;
+            });
+            return Object.keys(scores || {}).filter(function (id) {
+                return docs[id];
+            }).map(function (id) {
+                return {page: docs[id][0], title: docs[id][1], score: scores[id]};
+            }).sort(function (a, b) {
+                return b.score - a.score || (a.page < b.page ? -1 : 1);
+            });
+        });
+    };
+})();
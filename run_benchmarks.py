@@ -0,0 +1,219 @@
+"""Benchmark each stage of the conversion
+
+Times every stage of the pipeline separately on each help file of a folder
+(examples/input by default), and on three series of synthetic documents,
+10, 100 and 1000 times larger: the body of a help file repeated, an examples
+section with that many groups of '. command' lines (as in bayesmh.sthlp),
+and a paragraph and a table cell ten times that many lines long.
+Results are saved as JSON and can be compared against a stored baseline:
+
+- a stage is flagged if it takes more than --tolerance times its baseline
+- on each series of synthetic documents, a stage is flagged if its time per line
+  grows more than --tolerance times from the smallest to the largest document
+  (i.e. if its complexity is worse than linear)
+
+Usage:
+    python run_benchmarks.py --save-baseline benchmarks.json
+    python run_benchmarks.py --baseline benchmarks.json
+"""
+
+# -------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import collections
+
+from lxml import etree
+
+import smcl2html
+import smcl_parser
+
+# -------------------------------------------------------------
+# Functions
+# -------------------------------------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of smcl2html")
+    parser.add_argument('input', nargs='?', default='examples/input', help='folder with help files')
+    parser.add_argument('--adopath', '-a', action='store', help='path of base ado files')
+    parser.add_argument('--output', '-o', default='bench_output.json', help='where to save the results')
+    parser.add_argument('--baseline', '-b', help='compare against these results')
+    parser.add_argument('--save-baseline', help='also save the results as a baseline')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='keep the best of this many runs')
+    parser.add_argument('--synthetic', default='summarize.sthlp', help='help file to repeat into larger documents')
+    parser.add_argument('--scales', type=int, nargs='*', default=[10, 100, 1000], help='sizes of the synthetic documents')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown that counts as a regression')
+    return parser.parse_args()
+
+def time_stages(fn, adopath):
+    """Run the conversion of a file, timing each stage separately"""
+    current_file = os.path.splitext(os.path.basename(fn))[0]
+    times = collections.OrderedDict()
+
+    def timed(stage, f, *args, **kwargs):
+        start = time.perf_counter()
+        ans = f(*args, **kwargs)
+        times[stage] = time.perf_counter() - start
+        return ans
+
+    # Generators are consumed at each stage so they can be timed separately
+    lines = timed('read_smcl', lambda: list(smcl2html.read_smcl(fn)))
+    num_lines = len(lines)
+    lines = timed('newline_after_p_end', lambda: list(smcl2html.newline_after_p_end(lines)))
+    lines = timed('tokenize_lines', lambda: list(smcl2html.tokenize_lines(lines)))
+    lines = timed('expand_includes', lambda: list(smcl2html.expand_includes(lines, adopath)))
+    root = timed('smcl2tree', smcl2html.smcl2tree, lines)
+    root = timed('parse_blocks', smcl_parser.parse_blocks, root, current_file)
+    root = timed('parse_inlines', smcl_parser.parse_inlines, root, current_file) # Includes parse_improvements
+    timed('etree.tostring', etree.tostring, root, encoding='utf-8', method='html', pretty_print=True)
+
+    return num_lines, times
+
+def benchmark(fn, adopath, repeat):
+    """Best time of each stage over -repeat- runs"""
+    best = None
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            num_lines, times = time_stages(fn, adopath)
+        if best is None:
+            best = times
+        else:
+            best = collections.OrderedDict((stage, min(best[stage], t)) for (stage, t) in times.items())
+    best['total'] = sum(best.values())
+    return {'bytes': os.path.getsize(fn), 'lines': num_lines, 'stages': best}
+
+def make_synthetic(fn, scale, path):
+    """Repeat the body of a help file -scale- times"""
+    with open(fn, 'r', encoding='utf8') as f:
+        header = f.readline()
+        body = f.read()
+    if not body.endswith('\n'):
+        body += '\n'
+    base, ext = os.path.splitext(os.path.basename(fn))
+    synthetic_fn = os.path.join(path, '{}_x{}{}'.format(base, scale, ext))
+    with open(synthetic_fn, 'w', encoding='utf8') as f:
+        f.write(header)
+        for _ in range(scale):
+            f.write(body)
+    return synthetic_fn
+
+def make_examples(scale, path):
+    """Examples section with -scale- groups of consecutive '. command' lines"""
+    fn = os.path.join(path, 'examples_x{}.sthlp'.format(scale))
+    with open(fn, 'w', encoding='utf8') as f:
+        f.write('{smcl}\n{title:Examples}\n\n')
+        for i in range(scale):
+            f.write('{{pstd}}Example {}{{p_end}}\n'.format(i))
+            for j in range(10):
+                f.write('{{phang2}}{{cmd:. regress y x{} if group=={}}}{{p_end}}\n'.format(j, i))
+            f.write('\n')
+    return fn
+
+def make_paragraph(scale, path):
+    """A paragraph and a table cell of 10 * -scale- lines each"""
+    fn = os.path.join(path, 'paragraph_x{}.sthlp'.format(scale))
+    line = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod\n'
+    with open(fn, 'w', encoding='utf8') as f:
+        f.write('{smcl}\n{title:Description}\n\n{pstd}\n')
+        f.write(line * (10 * scale)) # All the text goes into the same <p>
+        f.write('{p_end}\n\n{p2col:{cmd:option}}\n')
+        f.write(line.replace('consectetur', '{it:consectetur}') * (10 * scale))
+        f.write('{p_end}\n')
+    return fn
+
+def run_benchmarks(input_path, adopath, repeat, synthetic, scales):
+    results = collections.OrderedDict()
+    all_fn = sorted(fn for fn in os.listdir(input_path) if os.path.splitext(fn)[-1] in smcl2html.valid_extensions)
+
+    for base_fn in all_fn:
+        fn = os.path.join(input_path, base_fn)
+        try:
+            results[base_fn] = benchmark(fn, adopath, repeat)
+        except Exception as e:
+            print('[Error] {}: {}'.format(base_fn, e))
+            continue
+        print('{:<24} {:>8.1f} ms'.format(base_fn, 1000 * results[base_fn]['stages']['total']))
+
+    with tempfile.TemporaryDirectory() as path:
+        for scale in scales:
+            series = [('examples', make_examples(scale, path)), ('paragraph', make_paragraph(scale, path))]
+            if synthetic:
+                series.insert(0, ('synthetic', make_synthetic(os.path.join(input_path, synthetic), scale, path)))
+            for name, fn in series:
+                base_fn = os.path.basename(fn)
+                results[base_fn] = benchmark(fn, adopath, repeat=1)
+                results[base_fn]['series'] = name
+                results[base_fn]['scale'] = scale
+                print('{:<24} {:>8.1f} ms'.format(base_fn, 1000 * results[base_fn]['stages']['total']))
+                os.remove(fn)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions against the baseline"""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for stage, t in result['stages'].items():
+            old_t = old['stages'].get(stage)
+            # Ignore stages too fast to be measured reliably
+            if old_t and max(t, old_t) > 0.001 and t > tolerance * old_t:
+                regressions.append('{} {}: {:.1f} ms vs {:.1f} ms in the baseline'.format(name, stage, 1000 * t, 1000 * old_t))
+    return regressions
+
+def check_scaling(results, tolerance):
+    """Return a list of stages whose time per line grows with the size of the synthetic documents"""
+    regressions = []
+    for series in sorted(set(result['series'] for result in results.values() if 'scale' in result)):
+        scaled = sorted((result for result in results.values() if result.get('series') == series),
+                        key=lambda result: result['scale'])
+        if len(scaled) < 2:
+            continue
+        small, large = scaled[0], scaled[-1]
+        for stage, t in large['stages'].items():
+            per_line_small = small['stages'][stage] / small['lines']
+            per_line_large = t / large['lines']
+            if t > 0.01 and per_line_large > tolerance * per_line_small:
+                regressions.append('{} {}: {:.2f} us/line at {}x vs {:.2f} us/line at {}x'.format(
+                    series, stage, 1e6 * per_line_large, large['scale'], 1e6 * per_line_small, small['scale']))
+    return regressions
+
+def save(fn, results):
+    meta = {'python': platform.python_version(), 'lxml': etree.__version__,
+            'platform': platform.platform(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(fn, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+# -------------------------------------------------------------
+# Main
+# -------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run_benchmarks(args.input, args.adopath, args.repeat, args.synthetic, args.scales)
+    save(args.output, results)
+    if args.save_baseline:
+        save(args.save_baseline, results)
+
+    problems = check_scaling(results, args.tolerance)
+    for problem in problems:
+        print('[Super-linear]', problem)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('[Regression]', regression)
+        problems += regressions
+
+    sys.exit(1 if problems else 0)
@@ -3,11 +3,13 @@
 This modules converts a SMCL file into Markdown/HTML.
 It does so in four passes:
 
-1. Convert SMCL directives into XML elements (e.g. <title>..</title>)
-2. Create a tree using lxml's ElementTree API
+1. Tokenize SMCL directives (e.g. {title:..}), streaming the file line by line
+2. Create a tree of XML elements (e.g. <title>..</title>) using lxml's TreeBuilder
 3. Modify the tree to create better abstractions
-   (e.g. tables, syntax tables, etc.)
+   (e.g. tables, syntax tables, etc.), then rewrite inline directives
+   and improve each block (code blocks, lists) in a single walk
 4. Walk through the tree and write Markdown
+   (with --stream, the passes run a block at a time, see stream_file)
 
 Notes:
  - A SMCL directive is of the form: {tag [options] [:content]}
@@ -27,8 +29,25 @@ Ideas:
 # -------------------------------------------------------------
 # Imports
 # -------------------------------------------------------------
+import io
 import os
 import re
+import sys
+import glob
+import json
+import mmap
+import time
+import codecs
+import hashlib
+import asyncio
+import functools
+import threading
+import traceback
+import contextlib
+import tracemalloc
+import collections
+import multiprocessing
+import concurrent.futures
 import argparse # https://mkaz.com/2014/07/26/python-argparse-cookbook/
 import webbrowser
 
@@ -36,14 +55,17 @@ from lxml import etree, html # http://infohost.nmt.edu/~shipman/soft/pylxml/web/
 from lxml.builder import E # http://lxml.de/tutorial.html#the-e-factory
 
 import smcl_parser
+import smcl_adopath
+import smcl_search
+import smcl_sidecar
 
 # -------------------------------------------------------------
 # Constants
 # -------------------------------------------------------------
 
-directive_regex = re.compile("""
-    (?P<head>[^}]*?) # Match as little as possible, excluding closing brackets
-    {
+brace_regex = re.compile('[{}]')
+
+header_regex = re.compile("""
     \ * # (optional spaces)
     (?P<tag>[\w]+) # Mandatory tag
     (?:
@@ -63,29 +85,316 @@ directive_regex = re.compile("""
     : # Separator between options and content
     (?P<content>[^{}]+)? # Content (text, nested directives, etc)
     )?
-    }
-    (?P<tail>.*) # Tail text and unparsed directives; greedy
     """, re.VERBOSE)
 
+# Stands in for a nested directive when matching the header of its parent
+# (it is neither a word character, a space, a quote, a colon nor a bracket)
+placeholder = '\x00'
+
+cleanup_regex = re.compile(r"""
+    {
+    (?:
+        (\.\.\.}) # Line continuation
+        |
+        \*\ (?![^\S\n]*$) # Comment (unless the line ends right after it)
+    )
+    """, re.VERBOSE | re.MULTILINE)
+
+valid_extensions = ('.smcl', '.sthlp', '.hlp', '.log')
+
+manifest_name = '.smcl2html-manifest.json'
+symbols_name = '.smcl2html-symbols.json'
+unresolved_name = 'unresolved-links.json'
+search_name = 'search'
+
+attribute_whitespace = str.maketrans('\t\n\r', '   ')
+
+# -------------------------------------------------------------
+# Include cache
+# -------------------------------------------------------------
+
+class IncludeCache(object):
+    """LRU cache of .ihlp fragments, stored tokenized and keyed by path and mtime
+
+    The cache is process-wide, so a fragment such as fvvarlist.ihlp is only
+    read and tokenized once when converting many help files. Its entries are
+    plain tuples, so they can be exported and loaded into worker processes:
+    in batch mode, the parent first reads the includes the files to convert
+    had in the last build (see preload_includes), so each worker doesn't
+    read them again.
+    It can be shared by threads (a fragment missed by two threads at once
+    is read by both).
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, fn):
+        key = (fn, os.stat(fn).st_mtime_ns)
+        with self.lock:
+            lines = self.entries.get(key)
+            if lines is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return lines
+            self.misses += 1
+
+        lines = tuple(tokenize_lines(newline_after_p_end(read_include(fn))))
+        self.add(key, lines)
+        return lines
+
+    def add(self, key, lines):
+        with self.lock:
+            self.entries[key] = lines
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def export(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def load(self, items):
+        for key, lines in items:
+            self.add(key, lines)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries), 'maxsize': self.maxsize}
+
+include_cache = IncludeCache()
+
+file_hashes = {} # Content hashes of sources and includes, see file_hash()
+
+# -------------------------------------------------------------
+# Adopath index
+# -------------------------------------------------------------
+
+adopath_indexes = {} # adopath -> smcl_adopath.AdoIndex, see adopath_index()
+adopath_lock = threading.Lock() # Builds and refreshes of the indexes, as convert() can run in several threads
+
+def adopath_index(adopath, db_fn=None):
+    """Index of the help files of an adopath (folders separated by os.pathsep), built once per process
+
+    -db_fn- is the SQLite file where the index is kept between runs (see
+    --adopath-index), only used the first time the index is built. An
+    smcl_adopath.AdoIndex can also be given instead of an adopath.
+    """
+    if isinstance(adopath, smcl_adopath.AdoIndex):
+        return adopath
+    with adopath_lock:
+        index = adopath_indexes.get(adopath)
+        if index is None:
+            index = adopath_indexes[adopath] = smcl_adopath.AdoIndex(smcl_adopath.split_adopath(adopath), db_fn=db_fn)
+            for path in index.missing():
+                print('[Warning] Base adopath does not exist:', path)
+    return index
+
+def find_include(index, name):
+    """Path of the .ihlp file -name-, refreshing the index once if it's not there (or was moved)"""
+    fn = index.find(name, ('.ihlp',))
+    if fn is None or not os.path.exists(fn):
+        with adopath_lock:
+            index.refresh()
+        fn = index.find(name, ('.ihlp',))
+    return fn
+
+link_symbols = None # Page name -> markers, of the pages converted in a batch (see --local-links)
+
+def worker_state(symbols=None):
+    """Arguments of init_worker(), so workers start with the caches of the parent (see preload_includes)"""
+    return include_cache.export(), dict(adopath_indexes), symbols
+
+def init_worker(cache_entries, indexes=None, symbols=None):
+    global link_symbols
+    include_cache.load(cache_entries)
+    include_cache.hits = include_cache.misses = 0 # Forked workers also inherit the counts of the parent
+    adopath_indexes.update(indexes or {})
+    link_symbols = symbols
+
+# -------------------------------------------------------------
+# Profiling
+# -------------------------------------------------------------
+
+class Profile(object):
+    """Timings and counters collected while converting one document (see --profile)
+
+    The front end is a chain of generators, so its stages are timed while
+    they stream: each stage is charged the time spent in it minus the time
+    spent in the stage it pulls lines from.
+    Peak memory is what Python allocated (libxml2 memory is not traced).
+    """
+
+    front_end = ('read_smcl', 'newline_after_p_end', 'tokenize_lines', 'expand_includes', 'smcl2tree')
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = collections.OrderedDict()
+        self.cpu = collections.OrderedDict()
+        self.elements = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.peak_memory = None
+
+    def add(self, stage, wall, cpu):
+        self.wall[stage] = self.wall.get(stage, 0.0) + wall
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + cpu
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def iterate(self, stage, lines):
+        """Time a streaming stage, including the stages it pulls from"""
+        lines = iter(lines)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                line = next(lines)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - wall, time.process_time() - cpu)
+                return
+            self.add(stage, time.perf_counter() - wall, time.process_time() - cpu)
+            yield line
+
+    def exclude_nested(self, stages):
+        """Subtract from each stage the time of the stage before it"""
+        for inner, outer in reversed(list(zip(stages, stages[1:]))):
+            self.wall[outer] -= self.wall[inner]
+            self.cpu[outer] -= self.cpu[inner]
+
+    def count(self, stage, root, before=None):
+        self.elements[stage] = {'before': before, 'after': count_elements(root)}
+        return self.elements[stage]['after']
+
+    def counter(self, stage):
+        return self.counts.setdefault(stage, collections.Counter())
+
+    def report(self):
+        stages = collections.OrderedDict((stage, {'wall': self.wall[stage], 'cpu': self.cpu[stage]}) for stage in self.wall)
+        return {'name': self.name,
+                'wall': sum(self.wall.values()),
+                'cpu': sum(self.cpu.values()),
+                'stages': stages,
+                'elements': self.elements,
+                'directives': {stage: dict(counts.most_common()) for (stage, counts) in self.counts.items()},
+                'peak_memory': self.peak_memory}
+
+def count_elements(root):
+    return sum(1 for _ in root.iter())
+
+@contextlib.contextmanager
+def trace_memory(profile):
+    """Record in -profile- the peak memory allocated by Python while converting a document"""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        profile.peak_memory = tracemalloc.get_traced_memory()[1]
+        if started:
+            tracemalloc.stop()
+
+def summarize_profiles(reports):
+    """Whole-run totals of the reports of each document"""
+    stages = collections.OrderedDict()
+    directives = {}
+    for report in reports:
+        for stage, times in report['stages'].items():
+            total = stages.setdefault(stage, {'wall': 0.0, 'cpu': 0.0})
+            total['wall'] += times['wall']
+            total['cpu'] += times['cpu']
+        for stage, counts in report['directives'].items():
+            directives.setdefault(stage, collections.Counter()).update(counts)
+    slowest = sorted(reports, key=lambda report: report['wall'], reverse=True)
+    try:
+        import resource # Not available on Windows
+    except ImportError:
+        resource = None
+    return {'documents': len(reports),
+            'wall': sum(report['wall'] for report in reports),
+            'cpu': sum(report['cpu'] for report in reports),
+            'stages': stages,
+            'directives': {stage: dict(counts.most_common()) for (stage, counts) in directives.items()},
+            'slowest': [(report['name'], report['wall']) for report in slowest[:10]],
+            'peak_memory': max((report['peak_memory'] or 0 for report in reports), default=0),
+            'peak_rss': max_rss(resource, 'RUSAGE_SELF'), # This process (the parent in batch mode)
+            'peak_rss_children': max_rss(resource, 'RUSAGE_CHILDREN')} # Largest worker process that ended
+
+def max_rss(resource, who):
+    """Peak resident set size in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(getattr(resource, who)).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024 # Linux reports kilobytes
+    return peak_rss
+
+def save_profile(fn, reports):
+    with open(fn, 'w', encoding='utf8') as f:
+        json.dump({'run': summarize_profiles(reports), 'documents': reports}, f, indent=1)
+
 # -------------------------------------------------------------
 # Functions
 # -------------------------------------------------------------
 
 def parse_args():
     parser = argparse.ArgumentParser(description="smcl2html: convert Stata help files into HTML files (higher-level and more semantic tags)")
-    parser.add_argument('filename')
+    parser.add_argument('filename', help='help file, folder of help files to convert in batch, or "serve"')
+    parser.add_argument('outdir', nargs='?', help='output folder (batch mode), or folder of help files to serve besides the adopath')
     parser.add_argument('--output','-o', action='store', help='output filename' )
-    parser.add_argument('--adopath','-a', action='store', help='path of base ado files' )
+    parser.add_argument('--adopath','-a', action='store', help='path of base ado files (several folders can be separated by {})'.format(os.pathsep) )
+    parser.add_argument('--adopath-index', action='store', metavar='FILE', help='keep the index of the adopath in this SQLite file, refreshing only the folders that changed' )
     parser.add_argument('--standalone', '-s', action='store_true', help='inspect tex log' )
     parser.add_argument('--view', '-v', action='store_true', help='view html output in a browser' )
     parser.add_argument('--web', '-w', action='store_true', help='add links to navigate within website' )
     parser.add_argument('--xml', action='store_true', help='save intermediate XML file instead' )
+    parser.add_argument('--jobs', '-j', action='store', type=int, help='number of worker processes (batch mode; default: number of CPUs)' )
+    parser.add_argument('--force', '-f', action='store_true', help='convert all files, even if unchanged since the last run (batch mode)' )
+    parser.add_argument('--emit-json', action='store_true', help='also write a JSON file with the title, metadata, links and syntax tables of each page' )
+    parser.add_argument('--search-index', action='store_true', help='add the converted pages to a search index in outdir/search (batch mode)' )
+    parser.add_argument('--local-links', action='store_true', help='link to the converted pages and their markers instead of stata.com, and report the links not found (batch mode)' )
+    parser.add_argument('--profile', action='store', metavar='REPORT', help='save timings and counters of each stage as JSON' )
+    parser.add_argument('--stream', action='store_true', help='write each block as soon as it is parsed, instead of the whole page at the end' )
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (serve mode)' )
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (serve mode)' )
+    parser.add_argument('--cache-size', type=int, default=256, help='number of rendered pages kept in memory (serve mode)' )
     args = parser.parse_args()
+    if args.xml and (args.stream or args.emit_json):
+        parser.error('--xml cannot be used with --stream or --emit-json')
+
+    # Serve mode: render help pages on demand
+    args.serve = args.filename == 'serve' and not os.path.exists(args.filename)
+    if args.serve:
+        if not (args.adopath or args.outdir):
+            parser.error('serve needs an --adopath or a folder of help files')
+        args.batch = False
+        return args
+
+    # Batch mode: convert a whole folder
+    args.batch = os.path.isdir(args.filename)
+    if args.batch:
+        if args.xml or args.view:
+            parser.error('--xml and --view cannot be used when converting a folder')
+        args.output = os.path.abspath(args.outdir or args.output or '.')
+        return args
+    elif args.outdir:
+        parser.error('an output folder can only be given when converting a folder')
+    elif args.local_links or args.search_index:
+        parser.error('--local-links and --search-index can only be used when converting a folder')
 
     # Check that file exists and has correct extension
     fn = args.filename
     assert fn, "File {} does not exist or pattern matches no file".format(fn)
-    valid_extensions = ('.smcl', '.sthlp', '.hlp', '.log')
     assert os.path.splitext(fn)[-1] in valid_extensions, "File {} has an unexpected extension".format(fn)
 
     args.current_file = os.path.splitext(os.path.basename(args.filename))[0]
@@ -99,70 +408,346 @@ def parse_args():
 # -------------------------------------------------------------
 
 def read_smcl(fn):
-    with open(fn, 'r', encoding='utf8') as f:
-       smcl = f.readline().strip()
-       assert smcl == '{smcl}', 'First line must be "{smcl}"'
-       lines = f.readlines()
-    return lines
-
-def expand_includes(lines, adopath):
-    includes = [ ( i , line[13:].strip() ) for (i,line) in enumerate(lines) if line.startswith('INCLUDE help ')]
-    if os.path.exists(adopath):
-        for i, cmd in reversed(includes):
-            fn = os.path.join(adopath, cmd[0], cmd if cmd.endswith('.ihlp') else cmd + '.ihlp')
-            with open(fn, 'r') as f:
-                content = f.readlines()
-            if content[0].startswith('{* *! version'):
-                content.pop(0)
-            lines[i:i+1] = content
-    elif adopath:
-        print('[Warning] Base adopath does not exist:', adopath)
-    return lines
+    with map_file(fn) as data:
+        yield from read_smcl_data(data)
 
-def newline_after_p_end(lines):
-    # Iterate with while because I will be expanding -lines- on the go
-    i = 0
-    while i<len(lines):
-        line = lines[i]
-        if '{p_end}' in line and not line.strip().endswith('{p_end}'):
-            newlines = line.split('{p_end}', 1) # Split line in two
-            newlines[0] = newlines[0] + '{p_end}\n'
-            lines[i:i+1] = newlines
-        i += 1
-    return lines
-
-def smcl2xml(lines):
-    lines = [parse_line(line) for line in lines]
-    xml = '<smcl>' + '<newline/>'.join(lines) + '</smcl>'
-    return xml
-
-def parse_line(line):
-    line = cleanup_line(line)
+def read_smcl_data(data):
+    """Same as read_smcl(), from the (memory-mapped) bytes of a help file"""
+    encoding, start = detect_encoding(data)
+    end = line_end(data, start)
+    assert data[start:end].strip() == b'{smcl}', 'First line must be "{smcl}"'
+    yield from read_data_lines(data, end, encoding)
+
+def read_smcl_file(f):
+    smcl = f.readline().strip()
+    assert smcl == '{smcl}', 'First line must be "{smcl}"'
+    yield from read_lines(f)
+
+def read_source(source):
+    """Read the lines of a help file given as a path, SMCL text, bytes or a file object"""
+    if hasattr(source, 'read'):
+        data = source.read() # The contents of a file object are never a path
+        if isinstance(data, bytes):
+            return read_smcl_data(data)
+        return read_smcl_file(io.StringIO(data.lstrip('\ufeff'))) # Text files opened as utf-8 keep their BOM
+    if isinstance(source, bytes):
+        return read_smcl_data(source)
+    elif not is_smcl_text(source):
+        return read_smcl(source)
+    return read_smcl_file(io.StringIO(source.lstrip('\ufeff')))
+
+def source_name(source):
+    """Name of a help file given as a path or a file object, without extension"""
+    fn = getattr(source, 'name', source) # Files opened from a path have a name
+    if not isinstance(fn, (str, os.PathLike)) or is_smcl_text(fn):
+        raise ValueError('the name of the help file must be given when converting its contents')
+    return os.path.splitext(os.path.basename(fn))[0]
+
+def is_smcl_text(source):
+    return isinstance(source, str) and source.lstrip('\ufeff').lstrip().startswith('{smcl}')
+
+@contextlib.contextmanager
+def map_file(fn):
+    """Memory-map a file, read-only (mmap can't map empty files)"""
+    with open(fn, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+def detect_encoding(data):
+    """Return the encoding of a help file and where its text starts (after the BOM, if any)
+
+    Files with a BOM are UTF-8. Otherwise the encoding is None: help files are
+    UTF-8 since Stata 14 and Latin-1 before, which read_data_lines() tells
+    apart as it decodes them.
+    """
+    if data[:3] == codecs.BOM_UTF8:
+        return 'utf-8', 3
+    return None, 0
+
+def line_end(data, pos):
+    """Position after the line of data that starts at pos"""
+    end = data.find(b'\n', pos)
+    return len(data) if end < 0 else end + 1
+
+def read_data_lines(data, pos, encoding=None, size=65536):
+    """Same as read_lines(), decoding bytes from pos on
+
+    Without an -encoding-, chunks are decoded as UTF-8 until one is not valid
+    UTF-8, and as Latin-1 from that chunk on. Chunks end at a newline, so a
+    character is never split between two of them.
+    """
+    while pos < len(data):
+        end = line_end(data, pos + size)
+        try:
+            chunk = str(data[pos:end], encoding or 'utf-8')
+        except UnicodeDecodeError:
+            if encoding:
+                raise
+            encoding = 'latin-1'
+            chunk = str(data[pos:end], encoding)
+        pos = end
+        if '\r' in chunk:
+            chunk = chunk.replace('\r\n', '\n').replace('\r', '\n') # As files opened in text mode
+        lines = cleanup(chunk).split('\n')
+        if not lines[-1]:
+            lines.pop()
+        for line in lines:
+            yield line.rstrip() # Only allocates if there is trailing whitespace
 
+def read_lines(f, size=65536):
+    """Read a file in chunks of whole lines, cleaning up each chunk at once"""
     while True:
-        m = directive_regex.match(line)
-        if not m:
+        chunk = f.read(size)
+        if not chunk:
             break
-        opt = m.group('options')
-        tag = m.group('tag')
-        content = m.group('content')
-        attrib = " options='{}'".format(opt) if opt else ''
-        if content:
-            element = '<{tag}{attrib}>{content}</{tag}>'.format(tag=tag, attrib=attrib, content=content)
+        if not chunk.endswith('\n'):
+            chunk += f.readline() # Complete the last line
+        lines = cleanup(chunk).split('\n')
+        if not lines[-1]:
+            lines.pop()
+        for line in lines:
+            yield line.rstrip() # Only allocates if there is trailing whitespace
+
+def newline_after_p_end(lines):
+    """Start a new line after every {p_end}, in a single pass over each line"""
+    for line in lines:
+        if '{p_end}' not in line:
+            yield line
+            continue
+        pieces = line.split('{p_end}')
+        tail = pieces.pop()
+        for piece in pieces:
+            yield piece + '{p_end}'
+        if tail:
+            yield tail
+
+def tokenize_lines(lines):
+    """Yield the tokens of each line as a tuple"""
+    for line in lines:
+        yield tuple(tokenize_line(line))
+
+def expand_includes(lines, adopath, deps=None):
+    """Replace tokenized lines like "INCLUDE help fvvarlist" with the tokenized .ihlp file
+
+    The .ihlp files are looked up in the index of the adopath, which can list
+    several folders (separated by os.pathsep), or in -adopath- itself if it's
+    an smcl_adopath.AdoIndex; the index is refreshed when a file isn't found,
+    as it may have been added since. The paths of the included files are
+    appended to -deps-, if given.
+    """
+    index = adopath_index(adopath) if adopath else None
+    if not index or len(index.missing()) == len(index.paths):
+        yield from lines
+        return
+
+    for tokens in lines:
+        if not (tokens and tokens[0][0] == 'text' and tokens[0][1].startswith('INCLUDE help ')):
+            yield tokens
+            continue
+        cmd = tokens[0][1][13:].strip()
+        name = cmd[:-5] if cmd.endswith('.ihlp') else cmd
+        fn = find_include(index, name) or os.path.join(index.paths[0], cmd[0], name + '.ihlp') # Fails as before
+        if deps is not None:
+            deps.append(fn)
+        yield from include_cache.get(fn)
+
+def read_include(fn):
+    with map_file(fn) as data:
+        encoding, start = detect_encoding(data)
+        end = line_end(data, start)
+        if data[start:end].startswith(b'{* *! version'):
+            start = end # Skip the version comment
+        yield from read_data_lines(data, start, encoding)
+
+def smcl2tree(lines):
+    """Build the <smcl> tree by feeding the tokens of each line into a TreeBuilder"""
+    elements = iter_tree(lines)
+    root = next(elements)
+    for _ in elements:
+        pass
+    return root
+
+def iter_tree(lines):
+    """Same as smcl2tree(), yielding the root first and then each of its children once built
+
+    A child is built once the next one starts, as text after it still goes
+    to its tail. Lines are only read as the children are requested, so the
+    block parser can start before the file is fully read (see --stream).
+    """
+    builder = etree.TreeBuilder()
+    start, end, data = builder.start, builder.end, builder.data
+    no_attrib = {}
+    depth = 0
+    last = None # Child of the root still being built
+
+    yield start('smcl', no_attrib)
+    for i, tokens in enumerate(lines):
+        if i:
+            element = start('newline', no_attrib)
+            end('newline')
+            if depth == 0:
+                if last is not None:
+                    yield last
+                last = element
+        for token in tokens:
+            kind = token[0]
+            if kind == 'text':
+                data(token[1])
+                continue
+            elif kind == 'end':
+                end(token[1])
+                depth -= 1
+                continue
+            elif token[2]:
+                # Normalize whitespace as an XML parser would do with attribute values
+                element = start(token[1], {'options': token[2].translate(attribute_whitespace)})
+            else:
+                element = start(token[1], no_attrib)
+            if depth == 0:
+                if last is not None:
+                    yield last
+                last = element
+            depth += 1
+    end('smcl')
+    builder.close()
+    if last is not None:
+        yield last
+
+def tree2xml(root):
+    """Serialize the <smcl> tree, only for debug purposes"""
+    xml = etree.tostring(root, encoding='unicode')
+    return xml.replace('<newline/>', '<newline/>\n')
+
+def tokenize_line(line):
+    """Scan a line once, yielding ('text', s), ('start', tag, options) and ('end', tag) tokens
+
+    Nested directives are resolved with a stack of open brackets: each closing
+    bracket completes the innermost open directive, so directives are parsed
+    inside-out in the order of their closing brackets.
+    If a directive is malformed, it and the rest of the line are kept as text.
+    """
+    stack = [] # Open directives: [position of bracket, text and nested directives]
+    pos = 0
+
+    for m in brace_regex.finditer(line):
+        i = m.start()
+
+        if line[i] == '{':
+            if stack:
+                if pos < i:
+                    add_item(stack[-1], line[pos:i])
+            elif pos < i:
+                yield ('text', line[pos:i])
+            stack.append([i, None])
+            pos = i + 1
+            continue
+
+        if not stack:
+            # Unbalanced closing bracket; leave the rest of the line as text
+            yield ('text', line[pos:])
+            return
+
+        start, items = stack[-1]
+        if items is None:
+            directive = parse_directive(line, start + 1, i)
         else:
-            element = '<{tag}{attrib}/>'.format(tag=tag, attrib=attrib)
-        line = m.group('head') + element + m.group('tail')
-    return line
-
-def cleanup_line(line):
-    line = line.rstrip()
-    line = line.replace('{...}', '{nobreak}')
-    line = line.replace('{* ', '{comment ')
-    line = line.replace('&','&amp;') # Else lxml crashes
-    line = line.replace("'",'&apos;') # Else lxml crashes
-    line = line.replace('<','&lt;') # Else lxml crashes
-    line = line.replace('>','&gt;') # Else lxml crashes
-    return line
+            directive = parse_nested_directive(items + [line[pos:i]])
+
+        if directive is None:
+            # Malformed directive; leave it and the rest of the line as text
+            yield from merge_text(flatten_items(stack, line[pos:]))
+            return
+
+        stack.pop()
+        if stack:
+            add_item(stack[-1], directive)
+        else:
+            yield from directive
+        pos = i + 1
+
+    # Directives that are still open are also left as text
+    if stack:
+        yield from merge_text(flatten_items(stack, line[pos:]))
+    elif pos < len(line):
+        yield ('text', line[pos:])
+
+def add_item(frame, item):
+    # Directives without nested directives are matched in place,
+    # so their items are only kept once the first child shows up
+    if frame[1] is None:
+        frame[1] = []
+    frame[1].append(item)
+
+def parse_directive(line, start, end):
+    """Return the tokens of a directive without nested directives, or None if it's malformed"""
+    m = header_regex.fullmatch(line, start, end)
+    if not m:
+        return None
+    tag = m.group('tag')
+    content = m.group('content')
+    if content is None:
+        return (('start', tag, m.group('options')), ('end', tag))
+    return (('start', tag, m.group('options')), ('text', content), ('end', tag))
+
+def parse_nested_directive(items):
+    """Return the tokens of a directive with nested directives, or None if it's malformed"""
+    flat = ''.join([item if item.__class__ is str else placeholder for item in items])
+    m = header_regex.fullmatch(flat)
+    if not m:
+        return None
+    tag = m.group('tag')
+    opt = m.group('options')
+    if opt is not None and placeholder in opt:
+        return None
+
+    tokens = [('start', tag, opt)]
+    offset = m.start('content') # -1 if there is no content
+    if offset >= 0:
+        # Nested directives can only be part of the content, after the header
+        for item in items:
+            if item.__class__ is not str:
+                tokens.extend(item)
+            elif offset >= len(item):
+                offset -= len(item)
+            else:
+                tokens.append(('text', item[offset:]))
+                offset = 0
+    tokens.append(('end', tag))
+    return tokens
+
+def flatten_items(stack, tail):
+    for _, items in stack:
+        yield ('text', '{')
+        for item in items or ():
+            if item.__class__ is str:
+                yield ('text', item)
+            else:
+                yield from item
+    if tail:
+        yield ('text', tail)
+
+def merge_text(tokens):
+    text = ''
+    for token in tokens:
+        if token[0] == 'text':
+            text += token[1]
+            continue
+        if text:
+            yield ('text', text)
+            text = ''
+        yield token
+    if text:
+        yield ('text', text)
+
+def cleanup(text):
+    """Rewrite {...} and {* } directives of a whole buffer with a single regex pass"""
+    return cleanup_regex.sub(cleanup_replace, text)
+
+def cleanup_replace(m):
+    return '{nobreak}' if m.group(1) else '{comment '
 
 def make_standalone(div, current_file):
     script = """
@@ -212,41 +797,643 @@ def make_standalone(div, current_file):
     #             <use xlink:href="#icon-backward2"></use></svg>
     return html
 
-def run_tests(input_path, output_path, adopath, standalone=True):
-    all_fn = os.listdir(input_path)
+def read_tree(fn, adopath, deps=None, profile=None):
+    """Transform SMCL representation into XML representation
 
-    for base_fn in all_fn:
-        fn = os.path.join(input_path, base_fn)
-        current_file = os.path.splitext(os.path.basename(fn))[0]
+    -fn- can also be SMCL text, bytes or a file object (see read_source).
+    """
+    if profile is not None:
+        return profile_tree(fn, adopath, deps, profile)
 
-        # Transform SMCL representation into XML representation
-        lines = read_smcl(fn)
-        lines = expand_includes(lines, adopath) # Replace lines like "INCLUDE help fvvarlist"
-        lines = newline_after_p_end(lines)
-        xml = smcl2xml(lines)
+    lines = read_source(fn)
+    lines = newline_after_p_end(lines)
+    lines = tokenize_lines(lines)
+    lines = expand_includes(lines, adopath, deps) # Replace lines like "INCLUDE help fvvarlist"
+
+    # Construct tree
+    return smcl2tree(lines)
 
-        # Construct tree
-        root = etree.fromstring(xml)
+def profile_tree(fn, adopath, deps, profile):
+    """Same as read_tree(), timing each stage"""
+    lines = profile.iterate('read_smcl', read_source(fn))
+    lines = profile.iterate('newline_after_p_end', newline_after_p_end(lines))
+    lines = profile.iterate('tokenize_lines', tokenize_lines(lines))
+    lines = profile.iterate('expand_includes', expand_includes(lines, adopath, deps))
+    with profile.stage('smcl2tree'):
+        root = smcl2tree(lines)
+    profile.exclude_nested(profile.front_end)
+    profile.count('smcl2tree', root)
+    return root
 
-        # Modify tree to create better abstractions
+def tree2html(root, current_file, standalone=False, web=False, profile=None, collectors=()):
+    # Modify tree to create better abstractions
+    if profile is None:
         root = smcl_parser.parse_blocks(root, current_file)
-        root = smcl_parser.parse_inlines(root, current_file)
-        root = smcl_parser.parse_improvements(root)
+        root = smcl_parser.parse_inlines(root, current_file) # Also does parse_improvements
+    else:
+        num_elements = count_elements(root)
+        with profile.stage('parse_blocks'):
+            root = smcl_parser.parse_blocks(root, current_file, counts=profile.counter('parse_blocks'))
+        num_elements = profile.count('parse_blocks', root, num_elements)
+        with profile.stage('parse_inlines'):
+            root = smcl_parser.parse_inlines(root, current_file, counts=profile.counter('parse_inlines'))
+        profile.count('parse_inlines', root, num_elements)
 
-        # Create complete html file (standalone option)
-        if standalone:
-            doctype = '<!DOCTYPE html>'
-            root = make_standalone(root, current_file)
-        else:
-            doctype = None
+    # Collect the blocks of the page for the search index and the JSON sidecar
+    for collector in collectors:
+        for block in root:
+            collector.add_block(block)
+        collector.finish(root)
 
-        # Export file
-        out_fn = os.path.join(output_path, current_file + '.html')
-        text = etree.tostring(root, encoding='utf-8', method='html', 
+    # Create complete html file (standalone option)
+    if standalone:
+        doctype = '<!DOCTYPE html>'
+
+        # Add back-link to website
+        if web:
+            root.insert(1, make_backlink(current_file))
+
+        root = make_standalone(root, current_file)
+    else:
+        doctype = None
+
+    with profile.stage('etree.tostring') if profile is not None else contextlib.nullcontext():
+        return etree.tostring(root, encoding='utf-8', method='html', 
                               pretty_print=True, xml_declaration=True, doctype=doctype)
+
+def make_backlink(current_file):
+    svg = E.svg(E.use(href='#icon-backward2'))
+    svg.set('class', 'icon icon-backward2')
+    href = "../software/" + current_file
+    span = E.span(' Back to index')
+    span.set('class', 'icon-text')
+    a = E.a(svg, span, href=href) #, style='vertical-align: middle;')
+    return E.p(a)
+
+def convert_file(fn, out_fn, adopath, standalone=False, web=False, deps=None, profile=None, stream=False,
+                 terms=None, emit_json=False):
+    """Convert a help file into an HTML file
+
+    The words of the page are added to -terms- (a smcl_search.Terms), if given.
+    With -emit_json-, its title, metadata, links and syntax tables are also
+    written next to it, as JSON (see smcl_sidecar).
+    """
+    current_file = os.path.splitext(os.path.basename(fn))[0]
+    sidecar = smcl_sidecar.Sidecar(current_file) if emit_json else None
+    collectors = [collector for collector in (terms, sidecar) if collector is not None]
+
+    if stream:
+        stream_file(fn, out_fn, adopath, standalone=standalone, web=web, deps=deps, profile=profile,
+                    collectors=collectors)
+    else:
+        with trace_memory(profile) if profile is not None else contextlib.nullcontext():
+            root = read_tree(fn, adopath, deps, profile=profile)
+            text = tree2html(root, current_file, standalone=standalone, web=web, profile=profile,
+                             collectors=collectors)
+
+        # Export file
         with open(out_fn, mode='wb') as fh:
             fh.write(text)
 
+    if sidecar is not None:
+        sidecar.write(sidecar_path(out_fn))
+
+def sidecar_path(out_fn):
+    return os.path.splitext(out_fn)[0] + '.json'
+
+# -------------------------------------------------------------
+# Library API
+# -------------------------------------------------------------
+
+def convert(source, name=None, standalone=False, web=False, adopath=None, deps=None):
+    """Convert a help file into HTML, without writing any file
+
+    -source- is the path of the help file (str or path-like), its SMCL text
+    (a str starting with "{smcl}"), its UTF-8 bytes, or a file object.
+    -name- is the name of the help command, used in the title and in links;
+    by default it's the file name without extension.
+    Returns the HTML as UTF-8 bytes. Can be called from several threads;
+    compiled patterns and the include cache are shared across calls.
+    The paths of the included files are appended to -deps-, if given.
+
+    Example:
+        html = smcl2html.convert('regress.sthlp', standalone=True, adopath='/usr/local/stata/ado/base')
+    """
+    if name is None:
+        name = source_name(source)
+    root = read_tree(source, adopath, deps)
+    return tree2html(root, name, standalone=standalone, web=web)
+
+Conversion = collections.namedtuple('Conversion', 'path html error')
+
+async def convert_many(paths, *, max_concurrency=None, executor=None, **options):
+    """Convert help files from asyncio, yielding a Conversion(path, html, error) as each one completes
+
+    -paths- can be an iterable or an async iterable, and -options- are those
+    of convert(). Files are read in threads and converted in -executor-
+    (by default, a pool of worker processes created for the call), so the
+    event loop is never blocked. At most -max_concurrency- files are read or
+    converted at once, and new ones are only started as results are consumed.
+    A file that fails gives a Conversion with the exception as -error-.
+    Closing the generator or cancelling the task that iterates it cancels
+    the conversions in progress.
+
+    Example:
+        async for result in smcl2html.convert_many(paths, max_concurrency=4, adopath=adopath):
+            ...
+    """
+    loop = asyncio.get_running_loop()
+    max_concurrency = max_concurrency or os.cpu_count() or 1
+    own_executor = executor is None
+    if own_executor:
+        if options.get('adopath'):
+            await loop.run_in_executor(None, adopath_index, options['adopath'])
+        executor = concurrent.futures.ProcessPoolExecutor(max_concurrency, initializer=init_worker,
+                                                          initargs=worker_state())
+
+    async def convert_path(path):
+        try:
+            data = await loop.run_in_executor(None, read_bytes, path)
+            html = await loop.run_in_executor(executor, functools.partial(
+                convert, data, source_name(path), **options))
+            return Conversion(path, html, None)
+        except Exception as e:
+            return Conversion(path, None, e)
+
+    if hasattr(paths, '__aiter__'):
+        paths = paths.__aiter__()
+        async def next_path():
+            try:
+                return await paths.__anext__()
+            except StopAsyncIteration:
+                return None
+    else:
+        paths = iter(paths)
+        async def next_path():
+            return next(paths, None)
+
+    pending = set()
+    try:
+        while True:
+            while len(pending) < max_concurrency:
+                path = await next_path()
+                if path is None:
+                    break
+                pending.add(asyncio.ensure_future(convert_path(path)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def read_bytes(fn):
+    with open(fn, 'rb') as f:
+        return f.read()
+
+# -------------------------------------------------------------
+# Streaming conversion
+# -------------------------------------------------------------
+
+def stream_file(fn, out_fn, adopath, standalone=False, web=False, deps=None, profile=None, collectors=()):
+    """Same as convert_file(), writing each block as soon as it's done
+
+    All the passes run at once, a block at a time: the file is read as the
+    block parser needs it, and each block is written once its inline
+    directives are done, so only a few blocks are held in memory.
+    The output is the same as convert_file(), except when viewer directives
+    appear after the first heading (see smcl_parser.iter_blocks).
+    With -profile-, the passes are timed together, as a single stage.
+    """
+    current_file = os.path.splitext(os.path.basename(fn))[0]
+    with trace_memory(profile) if profile is not None else contextlib.nullcontext(), \
+         profile.stage('stream') if profile is not None else contextlib.nullcontext():
+        lines = read_smcl(fn)
+        lines = newline_after_p_end(lines)
+        lines = tokenize_lines(lines)
+        lines = expand_includes(lines, adopath, deps)
+        elements = iter_tree(lines)
+        root = next(elements)
+
+        counts = profile.counter('stream') if profile is not None else None
+        blocks = smcl_parser.iter_blocks(root, current_file, counts, elements=elements, stream=True)
+        div = next(blocks)
+        blocks = smcl_parser.iter_inlines(div, blocks, current_file, counts)
+        if collectors:
+            blocks = collect_blocks(blocks, collectors)
+
+        # Write to a temporary file, so a failed conversion doesn't leave half a file
+        tmp_fn = out_fn + '.tmp'
+        try:
+            with open(tmp_fn, mode='wb') as fh:
+                write_blocks(fh, div, blocks, current_file, standalone=standalone, web=web)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError): # open() itself can fail
+                os.remove(tmp_fn)
+            raise
+        os.replace(tmp_fn, out_fn)
+        for collector in collectors:
+            collector.finish(div)
+
+def write_blocks(fh, div, blocks, current_file, standalone=False, web=False):
+    """Write the same HTML as tree2html(), a block of the <div> at a time
+
+    Each block is written in place, within a copy of the <div> where an element
+    stands for the blocks already written and another for the following ones,
+    so it's pretty printed as in the whole page. The start and end of the page
+    are written around the element that stands for the blocks written.
+    """
+    frame = etree.Element('div')
+    etree.SubElement(frame, 'smcl-written')
+    etree.SubElement(frame, 'smcl-following')
+    page = make_standalone(frame, current_file) if standalone else frame
+    doctype = '<!DOCTYPE html>' if standalone else None
+    kwargs = dict(encoding='utf-8', method='html', pretty_print=True)
+    started = False
+    done = None
+
+    if standalone and web:
+        blocks = with_backlink(blocks, current_file)
+
+    for block in blocks:
+        if done is not None:
+            if not started:
+                # Once a block is done, the header of the <div> is done too
+                frame.attrib.update(div.attrib)
+                frame.text = div.text
+                html = etree.tostring(page, xml_declaration=True, doctype=doctype, **kwargs)
+                fh.write(html[:html.index(b'<smcl-written>')])
+                started = True
+            frame.insert(1, done)
+            html = etree.tostring(frame, **kwargs)
+            fh.write(html[html.index(b'</smcl-written>') + 15:html.rindex(b'<smcl-following>')])
+            frame.remove(done)
+        done = block
+
+    # Write the last block and the rest of the page
+    frame.remove(frame[-1])
+    if done is not None:
+        frame.append(done)
+    if started:
+        html = etree.tostring(page, xml_declaration=True, doctype=doctype, **kwargs)
+        fh.write(html[html.index(b'</smcl-written>') + 15:])
+    else:
+        frame.attrib.update(div.attrib)
+        frame.text = div.text
+        frame.remove(frame[0])
+        fh.write(etree.tostring(page, xml_declaration=True, doctype=doctype, **kwargs))
+
+def collect_blocks(blocks, collectors):
+    """Pass each block to the collectors as it's written, as tree2html() does"""
+    for block in blocks:
+        for collector in collectors:
+            collector.add_block(block)
+        yield block
+
+def with_backlink(blocks, current_file):
+    """Add the back-link to the website after the first block, as tree2html() does"""
+    for i, block in enumerate(blocks):
+        yield block
+        if i == 0:
+            yield make_backlink(current_file)
+
+# -------------------------------------------------------------
+# Batch conversion
+# -------------------------------------------------------------
+
+def run_batch(input_path, output_path, adopath, standalone=False, web=False, jobs=None,
+              incremental=True, force=False, profile=None, stream=False, local_links=False,
+              search_index=False, emit_json=False, index_db=None):
+    """Convert all help files of a folder with a pool of worker processes
+
+    The largest files are scheduled first, so a large file doesn't start
+    at the very end of the run. A file that fails is reported but doesn't
+    stop the others.
+    With -incremental-, a manifest in the output folder is used to skip
+    files whose source, includes and converter are unchanged (unless -force-),
+    and the pages of files no longer in the folder are removed.
+    With -profile-, a report of each converted file is saved to that path.
+    With -local_links-, help links point to the pages of the batch (and their
+    markers), and the links that can't be resolved are saved to a report.
+    With -search_index-, the words of the converted pages are added to the
+    search index of the output folder (see smcl_search).
+    With -emit_json-, a JSON file is written next to each page (see smcl_sidecar).
+    With -index_db-, the index of the adopath is kept in that SQLite file.
+    """
+    global link_symbols
+    all_fn = sorted(fn for fn in os.listdir(input_path) if os.path.splitext(fn)[-1] in valid_extensions)
+    all_fn = [os.path.join(input_path, fn) for fn in all_fn]
+    all_fn.sort(key=os.path.getsize, reverse=True) # Stable, so ties remain sorted by name
+    os.makedirs(output_path, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
+    if adopath:
+        adopath_index(adopath, index_db) # Built once, and sent to the workers
+
+    link_symbols = build_symbols(all_fn, output_path, adopath, jobs, force) if local_links else None
+
+    manifest_fn = os.path.join(output_path, manifest_name)
+    build = build_key(standalone=standalone, web=web, adopath=adopath, local_links=local_links,
+                      search_index=search_index, emit_json=emit_json)
+    manifest = load_manifest(manifest_fn, build) if incremental and not force else {}
+    previous = load_manifest(manifest_fn, None) if incremental else {} # Of any build, for remove_stale_pages()
+
+    index = smcl_search.SearchIndex(os.path.join(output_path, search_name)) if search_index else None
+    if index is not None and not index.exists():
+        manifest = {} # Index every page
+
+    tasks = []
+    entries = {}
+    for fn in all_fn:
+        current_file = os.path.splitext(os.path.basename(fn))[0]
+        out_fn = os.path.join(output_path, current_file + '.html')
+        source_hash = file_hash(fn)
+        entry = manifest.get(os.path.basename(out_fn))
+        if entry and is_up_to_date(entry, fn, source_hash, out_fn, link_symbols) and \
+           (not emit_json or os.path.exists(sidecar_path(out_fn))):
+            entries[os.path.basename(out_fn)] = entry
+        else:
+            tasks.append((fn, out_fn, adopath, standalone, web, profile is not None, stream, search_index,
+                          emit_json))
+
+    jobs = min(jobs, len(tasks) or 1)
+    if jobs > 1:
+        preload_includes([task[0] for task in tasks], manifest_fn, os.path.join(output_path, symbols_name))
+    start = time.perf_counter()
+    results = []
+
+    if jobs == 1:
+        for result in map(convert_task, tasks):
+            report_progress(result, results, len(tasks))
+    else:
+        # Workers import lxml once and start with the caches, adopath index and symbol table of the parent
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=worker_state(link_symbols)) as pool:
+            for result in pool.imap_unordered(convert_task, tasks):
+                report_progress(result, results, len(tasks))
+
+    report_summary(results, time.perf_counter() - start, jobs, skipped=len(entries))
+
+    if incremental:
+        remove_stale_pages(output_path, previous, all_fn)
+
+    if local_links:
+        unresolved = {os.path.basename(result['output']): result['unresolved'] for result in results if not result['error']}
+        for name, entry in entries.items(): # Unchanged pages
+            unresolved.setdefault(name, entry.get('unresolved', []))
+        report_unresolved(os.path.join(output_path, unresolved_name), unresolved)
+
+    if index is not None:
+        update_search_index(index, all_fn, results)
+
+    # The manifest is saved last: if the run stops before, the pages are converted (and indexed) again
+    if incremental:
+        for result in results:
+            if not result['error']:
+                entry = entries[os.path.basename(result['output'])] = {
+                    'source': os.path.basename(result['filename']),
+                    'hash': result['hash'],
+                    'includes': result['includes']}
+                if local_links:
+                    entry['links'] = {name: symbol_digest(link_symbols.get(name)) for name in result['links']}
+                    entry['unresolved'] = result['unresolved']
+        save_manifest(manifest_fn, build, entries)
+
+    results = sorted(results, key=lambda result: result['filename'])
+    if profile:
+        save_profile(profile, [result['profile'] for result in results if result['profile']])
+    return results
+
+def convert_task(task):
+    fn, out_fn, adopath, standalone, web, profiled, stream, search_index, emit_json = task
+    start = time.perf_counter()
+    result = {'filename': fn, 'output': out_fn, 'size': os.path.getsize(fn), 'error': None, 'profile': None}
+    deps = []
+    profile = Profile(os.path.basename(fn)) if profiled else None
+    links = smcl_parser.Links(link_symbols) if link_symbols is not None else None
+    terms = smcl_search.Terms() if search_index else None
+    try:
+        result['hash'] = file_hash(fn)
+        with smcl_parser.linking_to(links):
+            convert_file(fn, out_fn, adopath, standalone=standalone, web=web, deps=deps, profile=profile,
+                         stream=stream, terms=terms, emit_json=emit_json)
+        result['includes'] = {dep: file_hash(dep) for dep in sorted(set(deps))}
+        if terms is not None:
+            result['search'] = terms.export()
+        if links is not None:
+            result['links'] = sorted(links.targets)
+            result['unresolved'] = sorted(set(links.unresolved))
+        if profile is not None:
+            result['profile'] = profile.report()
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    result['pid'] = os.getpid()
+    result['include_cache'] = include_cache.info()
+    return result
+
+def report_progress(result, results, total):
+    results.append(result)
+    status = 'FAILED' if result['error'] else '{:.2f}s'.format(result['seconds'])
+    width = len(str(total))
+    print('[{:>{w}}/{}] {} {}'.format(len(results), total, os.path.basename(result['filename']), status, w=width))
+
+def report_summary(results, seconds, jobs, skipped=0):
+    failed = sorted((result for result in results if result['error']), key=lambda result: result['filename'])
+    busy = sum(result['seconds'] for result in results)
+    print('Converted {} of {} files in {:.2f}s ({:.2f}s of work on {} processes)'.format(
+          len(results) - len(failed), len(results), seconds, busy, jobs))
+    if skipped:
+        print('Skipped {} unchanged files'.format(skipped))
+
+    # Each worker reports the running totals of its own include cache
+    caches = {result['pid']: result['include_cache'] for result in results}
+    hits = sum(info['hits'] for info in caches.values())
+    misses = sum(info['misses'] for info in caches.values())
+    if hits or misses:
+        print('Include cache: {} hits, {} misses'.format(hits, misses))
+
+    for result in failed:
+        print('[Error]', result['filename'])
+        print(result['error'].rstrip())
+
+def report_unresolved(fn, unresolved):
+    """Save the links of each page whose page or marker wasn't found, and count them"""
+    unresolved = {page: links for (page, links) in sorted(unresolved.items()) if links}
+    with open(fn, 'w', encoding='utf8') as f:
+        json.dump(unresolved, f, indent=1)
+    total = sum(len(links) for links in unresolved.values())
+    if total:
+        print('Unresolved links: {} in {} pages (see {})'.format(total, len(unresolved), fn))
+
+def update_search_index(index, all_fn, results):
+    """Replace the terms of the pages converted, and remove the pages whose source is gone"""
+    pages = {os.path.splitext(os.path.basename(fn))[0] + '.html' for fn in all_fn}
+    for result in results:
+        if not result['error']:
+            index.update(os.path.basename(result['output']), *result['search'])
+    for page in set(index.pages) - pages:
+        index.remove(page)
+    shards = index.save()
+    print('Search index: {} pages ({} shards written)'.format(len(index.pages), shards))
+
+def run_tests(input_path, output_path, adopath, standalone=True, jobs=1):
+    return run_batch(input_path, output_path, adopath, standalone=standalone, jobs=jobs, incremental=False)
+
+# -------------------------------------------------------------
+# Symbol table (see --local-links)
+# -------------------------------------------------------------
+
+def build_symbols(all_fn, output_path, adopath, jobs, force=False):
+    """Return the markers of every help file, by page name, for resolving links across pages
+
+    Files are scanned with the tokenizer (including their .ihlp files) by a
+    pool of worker processes. The table is cached in the output folder, so
+    only the files that changed (or whose includes changed) are scanned again.
+    """
+    cache_fn = os.path.join(output_path, symbols_name)
+    build = build_key(adopath=adopath)
+    cache = load_manifest(cache_fn, build) if not force else {}
+
+    entries = {}
+    tasks = []
+    for fn in all_fn:
+        entry = cache.get(os.path.basename(fn))
+        if entry and entry['hash'] == file_hash(fn) and includes_unchanged(entry['includes']):
+            entries[os.path.basename(fn)] = entry
+        else:
+            tasks.append((fn, adopath))
+
+    jobs = min(jobs, len(tasks) or 1)
+    if jobs > 1:
+        preload_includes([task[0] for task in tasks], cache_fn, os.path.join(output_path, manifest_name))
+    if jobs == 1:
+        results = list(map(collect_markers, tasks))
+    else:
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=worker_state()) as pool:
+            results = pool.map(collect_markers, tasks, chunksize=8)
+    for (fn, entry) in results:
+        if entry is not None: # Files that can't be read are not pages (their error is reported later)
+            entries[os.path.basename(fn)] = entry
+
+    save_manifest(cache_fn, build, entries)
+    print('Symbol table: {} pages ({} scanned)'.format(len(entries), len(tasks)))
+    return {os.path.splitext(name)[0]: frozenset(entry['markers']) for (name, entry) in entries.items()}
+
+def collect_markers(task):
+    """Return the markers of a help file, and their cache entry (None if the file can't be read)"""
+    fn, adopath = task
+    deps = []
+    markers = set()
+    try:
+        lines = expand_includes(tokenize_lines(newline_after_p_end(read_smcl(fn))), adopath, deps)
+        for tokens in lines:
+            for token in tokens:
+                if token[0] == 'start' and token[1] == 'marker' and token[2]:
+                    markers.add(token[2].strip())
+        entry = {'hash': file_hash(fn), 'markers': sorted(markers),
+                 'includes': {dep: file_hash(dep) for dep in sorted(set(deps))}}
+    except Exception:
+        entry = None
+    return fn, entry
+
+def symbol_digest(markers):
+    """Hash of the markers of a page linked to (None if there is no such page)"""
+    if markers is None:
+        return None
+    return hashlib.sha1('\n'.join(sorted(markers)).encode('utf8')).hexdigest()
+
+# -------------------------------------------------------------
+# Incremental builds
+# -------------------------------------------------------------
+
+def file_hash(fn):
+    """SHA-1 of the contents of a file (memoized by size and mtime)"""
+    st = os.stat(fn)
+    key = (fn, st.st_size, st.st_mtime_ns)
+    digest = file_hashes.get(key)
+    if digest is None:
+        with open(fn, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        file_hashes[key] = digest
+    return digest
+
+def build_key(**options):
+    """Hash of the converter source code and of the options that affect the output"""
+    h = hashlib.sha1()
+    path = os.path.dirname(os.path.abspath(__file__))
+    for fn in sorted(glob.glob(os.path.join(path, 'smcl*.py'))):
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+    h.update(json.dumps(options, sort_keys=True).encode('utf8'))
+    return h.hexdigest()
+
+def remove_stale_pages(output_path, previous, all_fn):
+    """Remove the page and sidecar of each manifest entry whose source file is gone"""
+    pages = {os.path.splitext(os.path.basename(fn))[0] + '.html' for fn in all_fn}
+    for name in sorted(set(previous) - pages):
+        out_fn = os.path.join(output_path, name)
+        for fn in (out_fn, sidecar_path(out_fn)):
+            if os.path.exists(fn):
+                os.remove(fn)
+        print('Removed {} (source is gone)'.format(name))
+
+def load_manifest(fn, build):
+    """Return the entries of a build manifest, or none if it was built differently (any build if -build- is None)"""
+    try:
+        with open(fn, 'r', encoding='utf8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest['files'] if build is None or manifest.get('build') == build else {}
+
+def save_manifest(fn, build, entries):
+    manifest = {'build': build, 'files': entries}
+    with open(fn + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+def is_up_to_date(entry, fn, source_hash, out_fn, symbols=None):
+    """Whether a page is unchanged, and so are its includes and the pages it links to (given -symbols-)"""
+    if entry['hash'] != source_hash or not os.path.exists(out_fn):
+        return False
+    if symbols is not None:
+        if 'links' not in entry:
+            return False
+        for name, digest in entry['links'].items():
+            if symbol_digest(symbols.get(name)) != digest:
+                return False
+    return includes_unchanged(entry['includes'])
+
+def preload_includes(all_fn, *manifest_fns):
+    """Read into the include cache the includes of -all_fn- recorded by earlier builds
+
+    The manifests are those of the pages and of the symbol table, whatever
+    their build, as includes seldom change. Called before starting a pool,
+    so the workers receive the fragments instead of each reading them.
+    """
+    sources = {os.path.basename(fn) for fn in all_fn}
+    includes = set()
+    for manifest_fn in manifest_fns:
+        for name, entry in load_manifest(manifest_fn, None).items():
+            if entry.get('source', name) in sources:
+                includes.update(entry['includes'])
+    for fn in sorted(includes):
+        try:
+            include_cache.get(fn)
+        except Exception:
+            pass # Moved or broken, so left for the conversions to report
+
+def includes_unchanged(includes):
+    for dep, dep_hash in includes.items():
+        if not os.path.exists(dep) or file_hash(dep) != dep_hash:
+            return False
+    return True
+
 # -------------------------------------------------------------
 # Main
 # -------------------------------------------------------------
@@ -256,51 +1443,36 @@ if __name__ == '__main__':
     # Parse opts
     args = parse_args()
 
-    # Transform SMCL representation into XML representation
-    lines = read_smcl(args.filename)
-    lines = expand_includes(lines, args.adopath) # Replace lines like "INCLUDE help fvvarlist"
-    lines = newline_after_p_end(lines)
-    xml = smcl2xml(lines)
+    if args.serve:
+        import smcl_server
+        smcl_server.serve([args.outdir, args.adopath], host=args.host, port=args.port,
+                          jobs=args.jobs, cache_size=args.cache_size, index_db=args.adopath_index)
+        sys.exit(0)
+
+    if args.batch:
+        results = run_batch(args.filename, args.output, args.adopath,
+                            standalone=args.standalone, web=args.web, jobs=args.jobs, force=args.force,
+                            profile=args.profile, stream=args.stream,
+                            local_links=args.local_links, search_index=args.search_index, emit_json=args.emit_json,
+                            index_db=args.adopath_index)
+        sys.exit(1 if any(result['error'] for result in results) else 0)
+
+    if args.adopath:
+        adopath_index(args.adopath, args.adopath_index)
+
+    profile = Profile(os.path.basename(args.filename)) if args.profile else None
 
     if args.xml:
         # Only save intermediate XML file
-        xml = xml.replace('<newline/>', '<newline/>\n')
+        root = read_tree(args.filename, args.adopath, profile=profile)
         with open(args.output, mode='w') as fh:
-            fh.write(xml)
+            fh.write(tree2xml(root))
     else:
-        # Construct tree
-        root = etree.fromstring(xml)
-        #tree = etree.ElementTree(root)
-
-        # Modify tree to create better abstractions
-        root = smcl_parser.parse_blocks(root, args.current_file)
-        root = smcl_parser.parse_inlines(root, args.current_file)
-        root = smcl_parser.parse_improvements(root)
-
-        # Create complete html file (standalone option)
-        if args.standalone:
-            doctype = '<!DOCTYPE html>'
-
-            # Add back-link to website
-            if args.web:
-                svg = E.svg(E.use(href='#icon-backward2'))
-                svg.set('class', 'icon icon-backward2')
-                href = "../software/" + args.current_file
-                span = E.span(' Back to index')
-                span.set('class', 'icon-text')
-                a = E.a(svg, span, href=href) #, style='vertical-align: middle;')
-                backlink = E.p(a)
-                root.insert(1, backlink)
-
-            root = make_standalone(root, args.current_file)
-        else:
-            doctype = None
+        convert_file(args.filename, args.output, args.adopath, standalone=args.standalone, web=args.web, profile=profile,
+                     stream=args.stream, emit_json=args.emit_json)
 
-        # Export file
-        text = etree.tostring(root, encoding='utf-8', method='html', 
-                              pretty_print=True, xml_declaration=True, doctype=doctype)
-        with open(args.output, mode='wb') as fh:
-            fh.write(text)
+    if profile is not None:
+        save_profile(args.profile, [profile.report()])
     
     if args.view:
         webbrowser.open(args.output)
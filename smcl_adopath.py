@@ -0,0 +1,184 @@
+"""Index of the help files in the adopath
+
+Maps the name of every .sthlp, .hlp and .ihlp file in the adopath folders
+(e.g. base, site, PLUS and PERSONAL) to its path, size and mtime, so looking
+up an include or a help file is a dictionary lookup instead of probing the
+filesystem. Files are indexed in each folder and in its subfolders (such as
+ado/base/r), and the first folder of the adopath has precedence, as in Stata.
+
+The index can be saved into a SQLite file, and is refreshed incrementally:
+only the folders whose mtime changed (i.e. where files were added, removed
+or renamed) are scanned again.
+"""
+
+# -------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------
+import os
+import sqlite3
+import collections
+
+# -------------------------------------------------------------
+# Constants
+# -------------------------------------------------------------
+
+indexed_extensions = ('.sthlp', '.hlp', '.ihlp')
+help_extensions = ('.sthlp', '.hlp')
+
+schema = """
+    create table if not exists folders (path text primary key, parent text, mtime_ns integer);
+    create table if not exists files (path text primary key, folder text, name text, ext text,
+                                      size integer, mtime_ns integer);
+    create index if not exists files_folder on files (folder);
+"""
+
+Entry = collections.namedtuple('Entry', 'path size mtime_ns')
+Folder = collections.namedtuple('Folder', 'mtime_ns subfolders files') # files are (name, ext, Entry)
+
+# -------------------------------------------------------------
+# Index
+# -------------------------------------------------------------
+
+class AdoIndex(object):
+    """Help files of the adopath, by name and extension
+
+    -paths- are the folders of the adopath, in order of precedence, and
+    -db_fn- the SQLite file where the index is kept between runs (if any).
+    Sizes and mtimes are those of the last time a folder was scanned.
+    """
+
+    def __init__(self, paths, db_fn=None):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.db_fn = db_fn
+        self.folders = {} # path -> Folder
+        self.entries = {} # (name, ext) -> Entry
+        self.scanned = 0 # Folders scanned in the last refresh
+        if db_fn is not None:
+            self.load()
+        self.refresh()
+
+    def __getstate__(self):
+        # Copies sent to worker processes only look files up, and tell which folders are missing
+        folders = {path: Folder(None, (), ()) for path in self.paths if path in self.folders}
+        return {'paths': self.paths, 'db_fn': None, 'folders': folders, 'entries': self.entries, 'scanned': 0}
+
+    def subset(self, extensions):
+        """Copy of the index that only looks up files with one of -extensions- (such as '.ihlp')"""
+        index = AdoIndex.__new__(AdoIndex)
+        index.__dict__.update(self.__getstate__())
+        index.entries = {key: entry for (key, entry) in self.entries.items() if key[1] in extensions}
+        return index
+
+    def find(self, name, extensions=help_extensions):
+        """Path of the first file named -name- with one of -extensions-, or None"""
+        for ext in extensions:
+            entry = self.entries.get((name, ext))
+            if entry is not None:
+                return entry.path
+        return None
+
+    def entry(self, name, ext):
+        return self.entries.get((name, ext))
+
+    def missing(self):
+        """Folders of the adopath that don't exist"""
+        return [path for path in self.paths if path not in self.folders]
+
+    def refresh(self):
+        """Update the index, scanning again the folders that changed"""
+        self.scanned = 0
+        changed = []
+        removed = []
+        folders = {}
+        for path in self.paths:
+            folder = self.scan(path, folders, changed, removed)
+            for subfolder in folder.subfolders if folder else ():
+                self.scan(subfolder, folders, changed, removed)
+
+        entries = {}
+        for path in self.paths:
+            for folder in [path] + list(folders[path].subfolders if path in folders else ()):
+                for (name, ext, entry) in folders[folder].files if folder in folders else ():
+                    entries.setdefault((name, ext), entry)
+
+        # Swapped at once, as find() can be called from another thread meanwhile
+        self.folders, self.entries = folders, entries
+
+        if self.db_fn is not None and (changed or removed):
+            self.save(changed, removed)
+
+    def scan(self, path, folders, changed, removed):
+        """Add the Folder of -path- to -folders-, listing it again only if it changed"""
+        if path in folders:
+            return folders[path]
+        old = self.folders.get(path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            if old is not None:
+                removed.append(path)
+            return None
+        folder = old
+        if folder is None or folder.mtime_ns != mtime_ns:
+            self.scanned += 1
+            subfolders = []
+            files = []
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                if entry.is_dir():
+                    subfolders.append(entry.path)
+                    continue
+                name, ext = os.path.splitext(entry.name)
+                if ext in indexed_extensions and entry.is_file():
+                    st = entry.stat()
+                    files.append((name, ext, Entry(entry.path, st.st_size, st.st_mtime_ns)))
+            folder = Folder(mtime_ns, tuple(subfolders), tuple(files))
+            changed.append(path)
+            if old is not None:
+                removed.extend(set(old.subfolders) - set(subfolders))
+        folders[path] = folder
+        return folder
+
+    # Persistence
+
+    def connect(self):
+        db = sqlite3.connect(self.db_fn)
+        db.executescript(schema)
+        return db
+
+    def load(self):
+        db = self.connect()
+        try:
+            subfolders = collections.defaultdict(list)
+            files = collections.defaultdict(list)
+            folders = db.execute('select path, parent, mtime_ns from folders order by path').fetchall()
+            for (path, parent, _) in folders:
+                if parent is not None:
+                    subfolders[parent].append(path)
+            for (path, folder, name, ext, size, mtime_ns) in db.execute('select * from files order by path'):
+                files[folder].append((name, ext, Entry(path, size, mtime_ns)))
+        finally:
+            db.close()
+        self.folders = {path: Folder(mtime_ns, tuple(subfolders[path]), tuple(files[path]))
+                        for (path, _, mtime_ns) in folders}
+
+    def save(self, changed, removed):
+        parents = {subfolder: path for path in self.paths if path in self.folders
+                   for subfolder in self.folders[path].subfolders}
+        db = self.connect()
+        try:
+            with db:
+                for path in list(changed) + list(removed):
+                    db.execute('delete from folders where path=?', (path,))
+                    db.execute('delete from files where folder=?', (path,))
+                for path in changed:
+                    folder = self.folders[path]
+                    db.execute('insert into folders values (?, ?, ?)', (path, parents.get(path), folder.mtime_ns))
+                    db.executemany('insert into files values (?, ?, ?, ?, ?, ?)',
+                                   [(entry.path, path, name, ext, entry.size, entry.mtime_ns)
+                                    for (name, ext, entry) in folder.files])
+        finally:
+            db.close()
+
+def split_adopath(adopath):
+    """Folders of an adopath given as a single string (separated by os.pathsep)"""
+    return [path for path in adopath.split(os.pathsep) if path] if adopath else []
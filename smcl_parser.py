@@ -4,6 +4,9 @@
 import os
 import re
 import shlex
+import functools
+import threading
+import contextlib
 
 from lxml import etree # http://infohost.nmt.edu/~shipman/soft/pylxml/web/index.html
 from lxml.builder import E
@@ -33,28 +36,107 @@ opt_pat = re.compile("""
     \)
     """, re.VERBOSE)
 
+# -------------------------------------------------------------
+# Cursor
+# -------------------------------------------------------------
+
+class Cursor(object):
+    """Walk the children of the <smcl> root once, in order
+
+    The block parsers consume the children of the root by moving or removing
+    them, so the cursor skips the elements that are no longer in the root.
+    Unlike len(root), which is linear in lxml, looking ahead is cheap.
+
+    If the root is still being built, -elements- yields its children as they
+    are built (see smcl2html.iter_tree), and they are only requested when
+    the cursor reaches them.
+    """
+
+    def __init__(self, root, elements=None):
+        self.root = root
+        self.elements = list(root) if elements is None else []
+        self.pending = elements
+        self.pos = 0
+        self.jumps = {} # i -> j if elements i..j-1 are known to be consumed
+
+    def load(self):
+        """Request the next element built; False if there are none left"""
+        if self.pending is None:
+            return False
+        element = next(self.pending, None)
+        if element is None:
+            self.pending = None
+            return False
+        self.elements.append(element)
+        return True
+
+    def trim(self):
+        """Forget the elements before the current one, so they can be freed once written"""
+        pos = self.pos
+        del self.elements[:pos]
+        self.jumps = {i - pos: j - pos for i, j in self.jumps.items() if i >= pos}
+        self.pos = 0
+
+    def __iter__(self):
+        while True:
+            element = self.peek()
+            if element is None:
+                return
+            yield element
+
+    def skip(self, i):
+        """Position of the first element still in the root, starting at i"""
+        elements, root, jumps = self.elements, self.root, self.jumps
+        start = i
+        while i < len(elements) or self.load():
+            j = jumps.get(i)
+            if j is not None:
+                i = j
+            elif elements[i].getparent() is root:
+                break
+            else:
+                i += 1
+        # Don't scan again the elements consumed while the block at -start- is parsed
+        if i > start:
+            jumps[start] = i
+        return i
+
+    def peek(self, offset=0):
+        """Equivalent to root[offset], or None if there are not enough elements"""
+        if self.pos > 1024 and self.pending is not None:
+            self.trim()
+        i = self.pos = self.skip(self.pos)
+        for _ in range(offset):
+            i = self.skip(i + 1)
+        return self.elements[i] if i < len(self.elements) else None
+
 # -------------------------------------------------------------
 # Functions
 # -------------------------------------------------------------
 
 def parse_improvements(root):
     """Replace certain tables into lists or code blocks"""
+    code_blocks = CodeBlocks()
+    for block in list(root):
+        improve_block(block, code_blocks)
+    return root
 
-    convert_code(root)
+def improve_block(block, code_blocks):
+    """Improve a top-level block once its inline directives are done"""
+    if block.tag == 'p' and has_class(block, 'hang2'):
+        for candidate in [child for child in block if child.tag == 'code' and has_class(child, 'command')]:
+            code_blocks.add(candidate)
 
-    for element in root.cssselect('table.standard'):
-        if detect_ul(element):
-            convert_ul(element)
-        elif detect_ol(element):
-            convert_ol(element)
-    
-    #ok_paras = {'std', 'see', 'hang', 'more', 'in', 'hang2', 'more2'}
-    #for p in root.cssselect('p'):
-    #    cl = p.attrib.get('class', None)
-    #    if cl and cl not in ok_paras:
-    #        print(cl)
+    elif block.tag == 'table' and has_class(block, 'standard'):
+        if detect_ul(block):
+            convert_ul(block)
+        elif detect_ol(block):
+            convert_ol(block)
 
-    return root
+def has_class(element, name):
+    """Same as the CSS selector .name"""
+    cl = element.get('class')
+    return cl is not None and name in cl.split()
 
 
 def detect_ul(table):
@@ -118,116 +200,103 @@ def convert_ol(table):
         for td in tr[:2]:
             tr.remove(td)
 
-def convert_code(root):
-    candidates = root.cssselect('p.hang2 > code.command')
-    last_pos = -1
-    last_valid_code = last_valid_pre = None
-    for candidate in candidates:
+class CodeBlocks(object):
+    """Merge consecutive p.hang2 > code.command paragraphs of '. command' lines into <pre> blocks
+
+    A paragraph is merged into the previous code block if it is its next sibling
+    (merged paragraphs are removed, so the one after them becomes the next sibling).
+    """
+
+    def __init__(self):
+        self.last_valid_pre = None
+
+    def add(self, candidate):
         p = candidate.getparent()
         empty_tail = candidate.tail is None or not candidate.tail.strip()
         starts_with_dot = candidate.text and (candidate.text.startswith('. ') or candidate.text=='.')
         valid = p.text is None and empty_tail and candidate.text is not None and starts_with_dot
+        if not valid:
+            return
 
-        if valid:
-            pos = root.index(p)
-            assert pos>last_pos
-            candidate.text = candidate.text[2:] # Remove dot and add that in CSS so people can copy easily
+        candidate.text = candidate.text[2:] # Remove dot and add that in CSS so people can copy easily
 
-            # Move to pre block
-            if pos == last_pos + 1:
-                append_to_tail(last_valid_pre[-1], '\n')
-                candidate.set('class', 'language-stata')
-                last_valid_pre.append(candidate)
+        # Move to pre block
+        if self.last_valid_pre is not None and p.getprevious() is self.last_valid_pre:
+            append_to_tail(self.last_valid_pre[-1], '\n')
+            candidate.set('class', 'language-stata')
+            self.last_valid_pre.append(candidate)
 
-                if p.tail is not None:
-                    append_to_tail(last_valid_pre, p.tail)
-                root.remove(p)
+            if p.tail is not None:
+                append_to_tail(self.last_valid_pre, p.tail)
+            p.getparent().remove(p)
 
-            # Start new pre block
-            else:
-                p.tag = 'pre'
-                del p.attrib["class"]
-                candidate.set('class', 'language-stata')
-                last_valid_code = candidate
-                last_valid_pre = p
-                last_pos = pos
-
-def parse_inlines(root, current_file):
+        # Start new pre block
+        else:
+            p.tag = 'pre'
+            del p.attrib["class"]
+            candidate.set('class', 'language-stata')
+            self.last_valid_pre = p
+
+def parse_inlines(root, current_file, counts=None, improve=True):
+    """Rewrite inline directives, improving each top-level block as soon as it's done
+
+    Visiting the tree once is equivalent to rewriting all the directives and
+    then calling parse_improvements(), as improve_block() only looks at the
+    block and at the code block before it.
+    """
     assert root.tag=='div'
-    valid_tags = ('h1', 'h2', 'h3', 'h4', 'p', 
-                  'table', 'thead', 'tbody', 'tfoot', 'tr', 'td',
-                  'a', 'nav', 'ul', 'li', 'hr',
-                  'code', 'kbd', 'var', 'samp', 'br', 'span', 'strong', 'b')
-
-    custom_tags = ('newvar', 'var', 'vars', 'depvar', 'depvars', 'indepvars',
-                   'varname', 'varlist', 'depvarlist',
-                   'ifin', 'weight', 'dtype')
-
-    formatting_directives = ('sf', 'it', 'bf',
-                             'input', 'error', 'result', 'text',
-                             'inp', 'err', 'res', 'txt',
-                             'hilite', 'hi', 'ul')
+    for _ in iter_inlines(root, list(root), current_file, counts, improve):
+        pass
+    return root
 
-    for element in root.iterdescendants():
-        tag = element.tag
-        opt = element.get('options')
-        if tag in valid_tags:
-            continue
-        
-        if tag == 'cmd' and (element.text or len(element)):
-            parse_cmd(element)
-        elif tag == 'cmdab':
-            parse_cmdab(element)
-        elif tag == 'opt':
-            parse_opt(element, current_file)
-        elif tag == 'opth':
-            parse_opt(element, current_file, help=True)
-        elif tag == 'help':
-            parse_browse(element, current_file, is_help=True)
-        elif tag == 'helpb':
-            parse_browse(element, current_file, is_help=True, is_bold=True)
-        elif tag == 'manhelp':
-            parse_browse(element, current_file, is_help=True, is_man=True)
-        elif tag == 'manhelpi':
-            parse_browse(element, current_file, is_help=True, is_man=True, is_italics=True)
-        elif tag == 'browse':
-            parse_browse(element, current_file)
-        elif tag == 'manpage':
-            parse_pdf_link(element, is_manpage=True)
-        elif tag == 'mansection':
-            parse_pdf_link(element, is_mansection=True)
-        elif tag == 'manlink':
-            parse_pdf_link(element, is_manlink=True)
-        elif tag == 'manlinki':
-            parse_pdf_link(element, is_manlink=True, is_italics=True)
-        elif tag == 'break':
-            parse_break(element)
-        elif tag in custom_tags:
-            parse_custom(element)
-        elif tag in formatting_directives and (element.text or len(element)):
-            parse_formatting(element)
-        elif tag == 'hline' and opt is not None:
-            parse_hline(element, opt)
-        elif tag == 'stata':
-            parse_stata(element, opt)
-        elif tag == 'bind':
-            parse_bind(element)
-        else:
-            print('UNUSED INLINE:', etree.tostring(element))
-            element.tag = 'span'
-            if element.text is None:
-                element.text = ''
-            element.text = '{{{} {}{}{}}}'.format(tag, opt, ':' if element.text else '', element.text)
+def iter_inlines(div, blocks, current_file, counts=None, improve=True):
+    """Same as parse_inlines() over -blocks- (children of -div-), yielding each block once done
+
+    A block is done once the next one is improved, as it can still be merged
+    into it (see CodeBlocks). Merged blocks are not yielded.
+    """
+    context = Context(current_file, counts)
+    code_blocks = CodeBlocks()
+    done = None
+
+    for block in blocks:
+        for element in block.iter():
+            if element.tag in html_tags:
+                continue
+            dispatch(inline_handlers.get(element.tag), element, context, unused_inline)
+        if improve:
+            improve_block(block, code_blocks)
+        if block.getparent() is None:
+            continue # Merged into the previous code block
+        if done is not None:
+            yield done
+        done = block
+
+    if done is not None:
+        yield done
+
+def parse_blocks(root, current_file, counts=None):
+    blocks = iter_blocks(root, current_file, counts)
+    div = next(blocks)
+    for _ in blocks:
+        pass
+    return div
 
-    return root
+def iter_blocks(root, current_file, counts=None, elements=None, stream=False):
+    """Same as parse_blocks(), yielding the new <div> first and then each of its blocks once done
 
-def parse_blocks(root, current_file):
+    A block is done once the next one is added, as handlers can still append
+    to the tail of the last block or set its id. Blocks are also held until
+    the header (navigation menus and attributes of the <div>) is done:
+    by default at the end, as viewer directives can appear anywhere;
+    with -stream-, at the first heading (where the header ends in practice),
+    ignoring header directives after it with a warning.
+    -elements- is passed to the Cursor, if the root is still being built.
+    """
 
     # New tree
     div = etree.Element('div')
     div.set('class', 'smcl')
-    div.text = root.text
-    div.tail = root.tail
 
     # Title
     title = etree.SubElement(div, 'h1')
@@ -246,101 +315,54 @@ def parse_blocks(root, current_file):
     etree.SubElement(ul_external, 'li', attrib={'class':'description'}).text = 'Also see:'
     div.append(nav_external)
     
-    # Misc
-    table_margins = {'active':'', 'default': [0, 31, 35, 0]}
-    syntab_margins = {'active':'', 'default': [20]}
-    nobreak = False
-    link_id = None
-    remaining = 0
-
-    while len(root):
-        element = root[0]
-        tag = element.tag
-        opt = element.get('options')
-
-        syntab_bug = tag=='p2col' and len(root)>4 \
-            and root[1].tag=='p_end' and root[2].tag=='newline' and root[3].tag=='synopt'
-
-        # Meta directives
-        if tag == 'comment' and opt.startswith('*! '):
-            parse_starbang(div, element, opt)
-
-        elif tag == 'viewerjumpto':
-            parse_viewer(ul_internal, element, opt, current_file)
-
-        elif tag == 'vieweralsosee':
-            parse_viewer(ul_external, element, opt, current_file)
-
-        elif tag == 'viewerdialog':
-            remove(element, div, nested=True) # Can't access dialog tabs
-
-        # Margins (don't get saved into tree but affect subsequent blocks)
-        elif tag in ('p2colset','p2colreset','synoptset'):
-            parse_margins(table_margins, syntab_margins, element, opt, div)
-
-        # Line breaks
-        elif tag == 'nobreak':
-            nobreak = True
-            remove(element, div, nested=True)
-
-        elif nobreak and tag == 'newline':
-            nobreak = False
-            remove(element, div, nested=True)
-
-        # Marker tags are added as id's for the next block
-        elif tag == 'marker':
-            link_id = opt.strip()
-            remove(element, div, nested=True)
-
-        # Heading blocks (title and dlgtab)
-        elif tag in ('title', 'dlgtab'):
-            parse_heading(div, element, opt)
-            link_id = add_id(div, link_id)
-
-        # Horizontal rules
-        elif tag == 'hline':
-            parse_thematic_break(div, element)
-
-        # Para blocks (paragraphs)
-        elif tag == 'p' or pclass.match(tag):
-            parse_para(div, element, opt)
-            link_id = add_id(div, link_id)
-
-        # Table blocks (2 cols)
-        elif tag == 'p2col' and not syntab_bug:
-            parse_table(div, element, opt, table_margins, syntab_margins)
-            link_id = add_id(div, link_id)
-
-        # Syntax Table blocks (3 cols)
-        elif tag in ('synopthdr', 'synoptline', 'syntab', 'synopt', 'p2coldent') or syntab_bug:
-            if syntab_bug:
-                element.tag = 'syntab'
-                root.remove(root[1])
-            parse_syntab(div, element, opt, table_margins, syntab_margins)
-            link_id = add_id(div, link_id)
-
-        elif tag == 'newline':
-            if element.tail is None:
-                element.tail = ''
-            remove(element, div, nested=True, prefix='\n')
-
-        elif tag =='col':
-            parse_col(div, element, opt)
-            link_id = add_id(div, link_id)
-            
-        else:
-            #print('UNUSED BLOCK', etree.tostring(element))
-            div.append(element)
-            remaining += 1
-
-    # Remove navigation menus if not needed
-    if len(ul_internal)==1:
-        remove(nav_internal, div, nested=True) # Attach to previous element div<nav
-    if len(ul_external)==1:
-        remove(nav_external, div, nested=True) # Attach to previous element div<nav
+    # State shared by the block handlers
+    context = Context(current_file, counts)
+    context.div = div
+    context.cursor = cursor = Cursor(root, elements)
+    context.ul_internal = ul_internal
+    context.ul_external = ul_external
+    # Margins (don't get saved into tree but affect subsequent blocks)
+    context.table_margins = {'active':'', 'default': [0, 31, 35, 0]}
+    context.syntab_margins = {'active':'', 'default': [20]}
+
+    # The text of the root is complete once its first child is built
+    cursor.peek()
+    div.text = root.text
+    div.tail = root.tail
+    yield div
 
-    #print('[TODO] Remaining elements:', remaining)
-    return div
+    pending = title # First block not yielded yet
+    elements = iter(cursor)
+    while True:
+        # Text is only buffered while parsing, not while the blocks done are used elsewhere
+        with buffered_fragments() as fragments:
+            for element in elements:
+                dispatch(block_handler(element.tag), element, context, unused_block)
+                fragments.flush()
+                if stream and not context.header_done and div[-1].tag in ('h2', 'h3'):
+                    finish_header(context)
+                if context.header_done and pending.getnext() is not None:
+                    break
+            else:
+                break # No elements left
+
+        while pending.getnext() is not None:
+            block, pending = pending, pending.getnext()
+            yield block
+
+    if not context.header_done:
+        finish_header(context)
+    while pending is not None:
+        block, pending = pending, pending.getnext()
+        yield block
+
+def finish_header(context):
+    """Remove navigation menus if not needed"""
+    context.header_done = True
+    if len(context.ul_internal)==1:
+        remove(context.ul_internal.getparent(), context.div, nested=True) # Attach to previous element div<nav
+    if len(context.ul_external)==1:
+        remove(context.ul_external.getparent(), context.div, nested=True) # Attach to previous element div<nav
 
 # -------------------------------------------------------------
 
@@ -386,44 +408,43 @@ def parse_margins(table_margins, syntab_margins, element, opt, destination):
         syntab_margins['active'] = opt.split()
     remove(element, destination, nested=True)
 
-def parse_heading(div, element, opt):
+def parse_heading(div, cursor, element, opt):
     element.tag ='h2' if element.tag=='title' else 'h3'
     
     if opt:
         element.set('margins', opt.strip())
 
     # Discard first newline after title, use subsequent to leave larger bottom margins
-    eat_blank_lines(element, num_discard=1)
+    eat_blank_lines(cursor, element, num_discard=1)
     
     div.append(element) # Must be at the end
 
-def parse_thematic_break(div, element):
+def parse_thematic_break(div, cursor, element):
     # the <hr> element is now more akin to a thematic break:
     # http://html5doctor.com/small-hr-element/
     element.tag = 'hr'
-    eat_blank_lines(element, num_discard=1)
+    eat_blank_lines(cursor, element, num_discard=1)
     div.append(element) # Must be at the end
 
-def parse_para(div, para, opt):
+def parse_para(div, cursor, para, opt):
     if opt:
         del para.attrib['options']
     opt = parse_options(opt, 'para') if para.tag=='p' else para.tag[1:]
     para.tag = 'p'
     para.set('class', opt)
     move_tail_inside(para)
-    root = para.getparent()
     last_was_empty = False
 
-    while len(root)>1:
-        element = root[1]
+    while cursor.peek(1) is not None:
+        element = cursor.peek(1)
         tag = element.tag
 
         # End the paragraph
         if tag == 'p_end' or (tag == 'newline' and last_was_empty):
             safe_remove(element, para)
             # Pop newline if it follows {p_end}
-            if len(root)>1 and root[1].tag=='newline':
-                remove(root[1], para, nested=False)
+            if cursor.peek(1) is not None and cursor.peek(1).tag=='newline':
+                remove(cursor.peek(1), para, nested=False)
             break
 
         last_was_empty = False
@@ -439,15 +460,13 @@ def parse_para(div, para, opt):
             para.append(element)
 
     # Remove leading spaces; no real effect
+    flush_fragments()
     if para.text is not None:
         para.text = para.text.lstrip()
 
-    ## We can use subsequent newlines to leave wider bottom margins
-    eat_blank_lines(element, num_discard=0)
     div.append(para)
 
-def parse_table(div, element, opt, table_margins, syntab_margins):
-    root = element.getparent()
+def parse_table(div, cursor, element, opt, table_margins, syntab_margins):
     table = etree.Element('table') #, border='1')
     table.set('class', 'standard')
     last_tag = None
@@ -459,8 +478,7 @@ def parse_table(div, element, opt, table_margins, syntab_margins):
 
     last_was_empty = False
 
-    while len(root):
-        element = root[0]
+    for element in cursor:
         tag = element.tag
         opt = element.get('options')
 
@@ -479,11 +497,11 @@ def parse_table(div, element, opt, table_margins, syntab_margins):
 
         # END OF TABLE?
         elif tag==last_tag=='newline' and last_was_empty:
-            if len(root)==1 or root[1].tag not in ('p_end', 'p2col', 'p2colset', 'p2colreset'):
+            if cursor.peek(1) is None or cursor.peek(1).tag not in ('p_end', 'p2col', 'p2colset', 'p2colreset'):
                 safe_remove(element, table)
                 break
             else:
-                safe_remove(element, table[-1] if len(table) else table)
+                safe_remove(element, last_child(table))
 
         # End of the second column
         elif tag == 'p_end': 
@@ -515,20 +533,16 @@ def parse_table(div, element, opt, table_margins, syntab_margins):
         last_tag = tag
         if tag!='newline': last_was_empty = False
 
-    # We can use subsequent newlines to leave wider bottom margins
-    eat_blank_lines(table)
     div.append(table)
 
-def parse_syntab(div, element, opt, table_margins, syntab_margins):
+def parse_syntab(div, cursor, element, opt, table_margins, syntab_margins):
 
-    root = element.getparent()
     table = etree.Element('table') #, border='1')
     table.set('class', 'syntab')
     tfoot = etree.Element('tfoot')
     last_tag = None
 
-    while len(root):
-        element = root[0]
+    for element in cursor:
         tag = element.tag
         opt = element.get('options')
 
@@ -553,7 +567,7 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
 
         elif tag=='synoptline':
             pass # we shouldn't need to set the table lines explicitly
-            safe_remove(element, table[-1] if len(table) else table)
+            safe_remove(element, last_child(table))
 
         # SECTION HEADINGS - {syntab:text}
         elif tag=='syntab':
@@ -568,7 +582,7 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
         # STANDARD ROWS - {synopt:text1}text2
         elif tag=='synopt':
 
-            if not (len(table) and table[-1].tag=='tbody'):
+            if last_child(table).tag!='tbody':
                 tbody = etree.SubElement(table, 'tbody')
 
             tr = etree.SubElement(tbody, 'tr')
@@ -586,7 +600,7 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
             if td2.tail is not None:
                 td3.text = td2.tail
                 td2.tail = None
-            eat_row(root, td3)
+            eat_row(cursor, td3)
             tr.append(td3)
 
         # MARGIN DIRECTIVES
@@ -595,24 +609,24 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
 
         # END OF TABLE?
         elif tag==last_tag=='newline':
-            if len(root)==1 or root[1].tag not in ('syntab', 'synopt'):
+            if cursor.peek(1) is None or cursor.peek(1).tag not in ('syntab', 'synopt'):
                 safe_remove(element, table)
                 break # End the table
             else:
-                safe_remove(element, table[-1] if len(table) else table)
+                safe_remove(element, last_child(table))
 
         elif tag=='newline':
             # Add a space with newline
             add_leading_space_to_tail(element)
-            safe_remove(element, table[-1] if len(table) else table)
+            safe_remove(element, last_child(table))
 
         elif tag=='nobreak':
-            safe_remove(element, table[-1] if len(table) else table)
+            safe_remove(element, last_child(table))
 
         # {p2coldent char text1}text2
         elif tag=='p2coldent':
 
-            if not (len(table) and table[-1].tag=='tbody'):
+            if last_child(table).tag!='tbody':
                 tbody = etree.SubElement(table, 'tbody')
             
             tr = etree.SubElement(tbody, 'tr')
@@ -638,7 +652,7 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
             if td2.tail is not None:
                 td3.text = td2.tail
                 td2.tail = None
-            eat_row(root, td3)
+            eat_row(cursor, td3)
             tr.append(td3)
 
         # Para blocks will be treated as footnotes
@@ -649,8 +663,7 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
             remove(element, td) # Will always append to text b/c td.text is empty
 
             # We'll ignore the paragraph margins and just align with table, so we can discard the current directive
-            while len(root):
-                subelement = root[0]
+            for subelement in cursor:
                 subtag = subelement.tag
                 subopt = subelement.get('options')
 
@@ -667,19 +680,16 @@ def parse_syntab(div, element, opt, table_margins, syntab_margins):
 
         else:
             print('UNUSED IN SYNTAB:', etree.tostring(element))
-            safe_remove(element, table[-1] if len(table) else table)
+            safe_remove(element, last_child(table))
         
         last_tag = tag
 
     if len(tfoot):
         table.append(tfoot)
-    
-    # We can use subsequent newlines to leave wider bottom margins
-    eat_blank_lines(table)
 
     div.append(table)
 
-def parse_col(div, para, opt):
+def parse_col(div, cursor, para, opt):
 
     def calculate_offset(opt):
         return opt * 0.5
@@ -688,15 +698,14 @@ def parse_col(div, para, opt):
     opt = int(opt)
     para.tag = 'p'
     move_tail_inside(para)
-    root = para.getparent()
 
     offset = calculate_offset(opt)
     if offset:
         para.set('style', 'padding-left: {}rem;'.format(offset))
     del para.attrib['options']
 
-    while len(root)>1:
-        element = root[1]
+    while cursor.peek(1) is not None:
+        element = cursor.peek(1)
         tag = element.tag
         opt = int(element.get('options')) if tag == 'col' else None
 
@@ -977,15 +986,269 @@ def parse_bind(element):
     element.set('class', 'nowrap') # .nowrap { white-space: nowrap; }
 
 # -------------------------------------------------------------
+# Directive registry
+# -------------------------------------------------------------
+
+# Tags of elements that are already HTML, skipped by parse_inlines
+html_tags = frozenset(('h1', 'h2', 'h3', 'h4', 'p',
+                       'table', 'thead', 'tbody', 'tfoot', 'tr', 'td',
+                       'a', 'nav', 'ul', 'li', 'hr',
+                       'code', 'kbd', 'var', 'samp', 'br', 'span', 'strong', 'b'))
+
+# Directive name -> (handler, condition); see register_inline() and register_block()
+inline_handlers = {}
+block_handlers = {}
+
+class Context(object):
+    """State of the document being parsed, passed to every handler"""
+
+    def __init__(self, current_file, counts=None):
+        self.current_file = current_file
+        self.counts = counts # How many times each directive was seen (see --profile)
+
+        # Only used by parse_blocks
+        self.div = None
+        self.cursor = None
+        self.ul_internal = None
+        self.ul_external = None
+        self.table_margins = None
+        self.syntab_margins = None
+        self.nobreak = False
+        self.link_id = None
+        self.header_done = False
+
+    def add_id(self):
+        """Use the last {marker} as the id of the block just added"""
+        self.link_id = add_id(self.div, self.link_id)
+
+def register_inline(tags, handler, condition=None):
+    """Handle the inline directives in -tags- with handler(element, opt, context)
+
+    If condition(element, opt, context) is given and false, the directive is
+    left unconverted instead. Registering a directive again replaces its handler,
+    so site-specific directives can be added without changing this module.
+    """
+    for tag in tags.split():
+        inline_handlers[tag] = (handler, condition)
+
+def register_block(tags, handler, condition=None):
+    """Same as register_inline(), for directives at the start of a block
+
+    A block handler must consume its element (move or remove it from the root),
+    and can consume the following ones through context.cursor.
+    """
+    for tag in tags.split():
+        block_handlers[tag] = (handler, condition)
+
+def dispatch(entry, element, context, default):
+    """Call the handler of the element's directive, or -default- if there is none"""
+    opt = element.get('options')
+    if context.counts is not None:
+        context.counts[element.tag] += 1
+    if entry is not None:
+        handler, condition = entry
+        if condition is None or condition(element, opt, context):
+            return handler(element, opt, context)
+    return default(element, opt, context)
+
+def block_handler(tag):
+    entry = block_handlers.get(tag)
+    if entry is None and is_para_tag(tag):
+        entry = block_handlers['p']
+    return entry
+
+@functools.lru_cache(maxsize=None)
+def is_para_tag(tag):
+    """Paragraph directives such as {pstd}, {phang2} or {pmore}"""
+    return pclass.match(tag) is not None
+
+def unused_inline(element, opt, context):
+    tag = element.tag
+    print('UNUSED INLINE:', etree.tostring(element))
+    if context.counts is not None:
+        context.counts['unused ' + tag] += 1
+    element.tag = 'span'
+    if element.text is None:
+        element.text = ''
+    element.text = '{{{} {}{}{}}}'.format(tag, opt, ':' if element.text else '', element.text)
+
+def unused_block(element, opt, context):
+    #print('UNUSED BLOCK', etree.tostring(element))
+    context.div.append(element)
+
+def has_content(element, opt, context):
+    return element.text or len(element)
+
+def has_options(element, opt, context):
+    return opt is not None
+
+# Inline directives
+
+register_inline('cmd', lambda element, opt, context: parse_cmd(element), condition=has_content)
+register_inline('cmdab', lambda element, opt, context: parse_cmdab(element))
+register_inline('opt', lambda element, opt, context: parse_opt(element, context.current_file))
+register_inline('opth', lambda element, opt, context: parse_opt(element, context.current_file, help=True))
+register_inline('help', lambda element, opt, context: parse_browse(element, context.current_file, is_help=True))
+register_inline('helpb', lambda element, opt, context: parse_browse(element, context.current_file, is_help=True, is_bold=True))
+register_inline('manhelp', lambda element, opt, context: parse_browse(element, context.current_file, is_help=True, is_man=True))
+register_inline('manhelpi', lambda element, opt, context: parse_browse(element, context.current_file, is_help=True, is_man=True, is_italics=True))
+register_inline('browse', lambda element, opt, context: parse_browse(element, context.current_file))
+register_inline('manpage', lambda element, opt, context: parse_pdf_link(element, is_manpage=True))
+register_inline('mansection', lambda element, opt, context: parse_pdf_link(element, is_mansection=True))
+register_inline('manlink', lambda element, opt, context: parse_pdf_link(element, is_manlink=True))
+register_inline('manlinki', lambda element, opt, context: parse_pdf_link(element, is_manlink=True, is_italics=True))
+register_inline('break', lambda element, opt, context: parse_break(element))
+register_inline('newvar var vars depvar depvars indepvars varname varlist depvarlist ifin weight dtype',
+                lambda element, opt, context: parse_custom(element))
+register_inline('sf it bf input error result text inp err res txt hilite hi ul',
+                lambda element, opt, context: parse_formatting(element), condition=has_content)
+register_inline('hline', lambda element, opt, context: parse_hline(element, opt), condition=has_options)
+register_inline('stata', lambda element, opt, context: parse_stata(element, opt))
+register_inline('bind', lambda element, opt, context: parse_bind(element))
+
+# Block directives
+
+def block_viewer(element, opt, context):
+    if context.header_done:
+        return ignore_header(element, opt, context)
+    ul = context.ul_internal if element.tag=='viewerjumpto' else context.ul_external
+    parse_viewer(ul, element, opt, context.current_file)
+
+def block_starbang(element, opt, context):
+    if context.header_done:
+        return ignore_header(element, opt, context)
+    parse_starbang(context.div, element, opt)
+
+def ignore_header(element, opt, context):
+    """Header directives can't be used once the header has been written (see iter_blocks)"""
+    print('[Warning] {{{} {}}} after the first heading was ignored'.format(element.tag, opt))
+    remove(element, context.div, nested=True)
+
+def block_margins(element, opt, context):
+    parse_margins(context.table_margins, context.syntab_margins, element, opt, context.div)
+
+def block_nobreak(element, opt, context):
+    context.nobreak = True
+    remove(element, context.div, nested=True)
+
+def block_newline(element, opt, context):
+    if context.nobreak:
+        context.nobreak = False
+        remove(element, context.div, nested=True)
+    else:
+        if element.tail is None:
+            element.tail = ''
+        remove(element, context.div, nested=True, prefix='\n')
+
+def block_marker(element, opt, context):
+    """Marker tags are added as id's for the next block"""
+    context.link_id = opt.strip()
+    remove(element, context.div, nested=True)
+
+def block_heading(element, opt, context):
+    parse_heading(context.div, context.cursor, element, opt)
+    context.add_id()
+
+def block_para(element, opt, context):
+    parse_para(context.div, context.cursor, element, opt)
+    context.add_id()
+
+def block_table(element, opt, context):
+    if is_syntab_bug(context.cursor):
+        return block_syntab(element, opt, context)
+    parse_table(context.div, context.cursor, element, opt, context.table_margins, context.syntab_margins)
+    context.add_id()
+
+def block_syntab(element, opt, context):
+    cursor = context.cursor
+    if element.tag == 'p2col':
+        element.tag = 'syntab'
+        cursor.root.remove(cursor.peek(1))
+    parse_syntab(context.div, cursor, element, opt, context.table_margins, context.syntab_margins)
+    context.add_id()
+
+def block_col(element, opt, context):
+    parse_col(context.div, context.cursor, element, opt)
+    context.add_id()
+
+def is_syntab_bug(cursor):
+    """{p2col} followed by {p_end}, a newline and {synopt} starts a syntax table"""
+    return cursor.peek(4) is not None and cursor.peek(1).tag=='p_end' \
+        and cursor.peek(2).tag=='newline' and cursor.peek(3).tag=='synopt'
+
+register_block('comment', block_starbang,
+               condition=lambda element, opt, context: opt.startswith('*! '))
+register_block('viewerjumpto vieweralsosee', block_viewer)
+register_block('viewerdialog', lambda element, opt, context: remove(element, context.div, nested=True)) # Can't access dialog tabs
+register_block('p2colset p2colreset synoptset', block_margins)
+register_block('nobreak', block_nobreak)
+register_block('newline', block_newline)
+register_block('marker', block_marker)
+register_block('title dlgtab', block_heading)
+register_block('hline', lambda element, opt, context: parse_thematic_break(context.div, context.cursor, element))
+register_block('p', block_para) # Also {pstd}, {phang}, etc., see block_handler()
+register_block('p2col', block_table)
+register_block('synopthdr synoptline syntab synopt p2coldent', block_syntab)
+register_block('col', block_col)
+
+# -------------------------------------------------------------
+
+class Fragments(object):
+    """Text appended to the .text and .tail of elements, written once when flushed
+
+    Folding a long paragraph or table cell appends every line to the same
+    .text or .tail; doing so directly copies the whole string each time.
+    Until flush() is called, the new values can't be read from the elements.
+    """
+
+    def __init__(self):
+        self.pending = {} # (element, 'text' or 'tail') -> list of strings
+
+    def append(self, element, attr, text):
+        key = (element, attr)
+        parts = self.pending.get(key)
+        if parts is None:
+            current = getattr(element, attr)
+            parts = self.pending[key] = [] if current is None else [current]
+        parts.append(text)
+
+    def flush(self):
+        for (element, attr), parts in self.pending.items():
+            setattr(element, attr, ''.join(parts))
+        self.pending.clear()
+
+local = threading.local() # State of the document being parsed by each thread (fragments and links)
+
+@contextlib.contextmanager
+def buffered_fragments():
+    """Buffer append_to_tail() and append_to_text() until flushed"""
+    previous = getattr(local, 'fragments', None)
+    local.fragments = Fragments()
+    try:
+        yield local.fragments
+    finally:
+        local.fragments.flush()
+        local.fragments = previous
+
+def flush_fragments():
+    fragments = getattr(local, 'fragments', None)
+    if fragments is not None:
+        fragments.flush()
 
 def append_to_tail(element, text):
-    if element.tail is None:
+    fragments = getattr(local, 'fragments', None)
+    if fragments is not None:
+        fragments.append(element, 'tail', text)
+    elif element.tail is None:
         element.tail = text
     else:
         element.tail += text
 
 def append_to_text(element, text):
-    if element.text is None:
+    fragments = getattr(local, 'fragments', None)
+    if fragments is not None:
+        fragments.append(element, 'text', text)
+    elif element.text is None:
         element.text = text
     else:
         element.text += text
@@ -1008,12 +1271,12 @@ def safe_remove(element, destination):
 
 def remove(element, destination, nested=False, prefix=''):
     if element.tail is not None:
-        try:
+        if element.getparent() is destination:
             pos = destination.index(element) - 1 # Previous element
-        except ValueError:
+        else:
             pos = -1 # Last element
 
-        if len(destination) == 0 or pos == 0:
+        if not has_children(destination) or pos == 0:
             append_to_text(destination, prefix + element.tail)
         elif nested:
             append_to_tail(destination[pos], prefix + element.tail)
@@ -1021,6 +1284,51 @@ def remove(element, destination, nested=False, prefix=''):
             append_to_tail(destination, prefix + element.tail)
     element.getparent().remove(element)
 
+class Links(object):
+    """Help pages converted together, that help links can point to (see linking_to)
+
+    -pages- maps the name of each page to the set of its markers. The pages
+    linked to, and the links whose page or marker doesn't exist, are
+    collected while a document is parsed.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.targets = set() # Names of the pages linked to
+        self.unresolved = [] # Links not found, such as "regress##options"
+
+    def resolve(self, link, current_file):
+        """Local href of a help link (without "help "), or None if its page doesn't exist"""
+        name, anchor = help_target(link, current_file)
+        self.targets.add(name)
+        markers = self.pages.get(name)
+        if markers is None:
+            self.unresolved.append(link)
+            return None
+        if anchor and anchor not in markers:
+            self.unresolved.append(link)
+            anchor = ''
+        if name == current_file and anchor:
+            return '#' + anchor
+        return name + '.html' + ('#' + anchor if anchor else '')
+
+def help_target(link, current_file):
+    """Page name and marker of a help link (without "help "); the marker is '' if there is none"""
+    name, _, anchor = link.partition('##')
+    name = '_'.join(name.split()) or current_file # "regress postestimation" is regress_postestimation
+    anchor = anchor.split('|')[0].strip() # As in "##options|viewer"
+    return name, anchor
+
+@contextlib.contextmanager
+def linking_to(links):
+    """Resolve help links to the pages of -links- (a Links, or any object with its resolve()), instead of stata.com"""
+    previous = getattr(local, 'links', None)
+    local.links = links
+    try:
+        yield links
+    finally:
+        local.links = previous
+
 def fix_link(link, current_file, page=''):
     is_help = link.startswith('help ')
     is_pdf = link.startswith('pdf ')
@@ -1029,6 +1337,12 @@ def fix_link(link, current_file, page=''):
     elif is_pdf:
         link = link[4:]
 
+    links = getattr(local, 'links', None)
+    if is_help and links is not None:
+        href = links.resolve(link, current_file)
+        if href is not None:
+            return href
+
     if '##' in link:
         base, anchor = link.split('##')
         if base==current_file:
@@ -1045,12 +1359,13 @@ def fix_link(link, current_file, page=''):
         link = link.strip('"')
         return link
 
-def eat_blank_lines(element, num_discard=0):
+def eat_blank_lines(cursor, element, num_discard=0):
+    """Remove the newlines right after the element (the current one of the cursor)"""
     margin_bottom = 0
     num_discarded = 0
 
     while True:
-        active_element =  element.getnext()
+        active_element =  cursor.peek(1)
         
         if active_element is not None and active_element.tag=='newline':
             if num_discarded<num_discard:
@@ -1084,11 +1399,10 @@ def parse_options(options, block):
 
     return ans
 
-def eat_row(root, destination):
+def eat_row(cursor, destination):
     """Append until we encounter {p_end}"""
 
-    while len(root)>0:
-        element = root[0]
+    for element in cursor:
 
         # Stop on p_end
         if element.tag=='p_end':
@@ -1102,7 +1416,7 @@ def eat_row(root, destination):
             destination.append(element)
 
 def add_id(div, link_id):
-    if len(div)==0:
+    if not has_children(div):
         return link_id
     if link_id is None:
         return None
@@ -1116,3 +1430,10 @@ def add_leading_space_to_tail(element):
     tail = element.tail if element.tail is not None else ''
     element.tail = ' ' + tail
 
+def has_children(element):
+    """Same as len(element)>0, without counting all the children"""
+    return next(iter(element), None) is not None
+
+def last_child(element):
+    """Last child of an element, or the element itself if it has none"""
+    return element[-1] if has_children(element) else element
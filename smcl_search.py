@@ -0,0 +1,228 @@
+"""Inverted index of the converted help pages, for offline search (see --search-index)
+
+While a page is converted, Terms collects the words of its blocks, weighted by
+where they appear: h2/h3 headings, option names of syntax tables, markers and
+body text. SearchIndex then merges the terms of the pages converted in a batch
+into a folder of JSON files:
+
+    docs.json          [page, title] of each document id (null if removed)
+    terms-<xy>.json    {term: [[id, score], ...]} of the terms starting with xy
+
+so a browser only loads the shards of the words searched for (see js/search.js).
+When only some pages are converted again, only the shards where their old or
+new terms are get rewritten.
+
+Notes:
+ - Terms are lowercase ASCII words of at least two characters ("vce", "if",
+   "noconstant"), but not numbers; an underscore doesn't split a word
+   ("options_table")
+"""
+
+# -------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------
+import os
+import re
+import html
+import glob
+import json
+import collections
+
+# -------------------------------------------------------------
+# Constants
+# -------------------------------------------------------------
+
+term_regex = re.compile(r'[a-z0-9_]{2,}')
+option_regex = re.compile(r'[a-z0-9_]+')
+
+weights = {'heading': 10, 'option': 8, 'marker': 5, 'text': 1}
+
+stop_words = frozenset(('the', 'and', 'of', 'to', 'is', 'are', 'be', 'that', 'this', 'an'))
+
+# Words in different cells, items or paragraphs must not be joined
+spaced_tags = frozenset(('p', 'h1', 'h2', 'h3', 'h4', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'td',
+                         'ul', 'li', 'br', 'pre', 'div', 'nav'))
+
+state_name = '.state.json'
+
+# -------------------------------------------------------------
+# Terms of a page
+# -------------------------------------------------------------
+
+class Terms(object):
+    """Words of the blocks of a page and their scores
+
+    Blocks are added once their inline directives are done. The title is the
+    paragraph after the "Title" heading (e.g. "[R] regress -- Linear
+    regression"), if any.
+    """
+
+    def __init__(self):
+        self.scores = collections.Counter()
+        self.title = None
+        self.in_title = False
+
+    def add_block(self, block):
+        if not isinstance(block.tag, str) or block.tag in ('h1', 'nav'):
+            return
+        text = element_text(block)
+
+        if block.tag in ('h2', 'h3'):
+            self.add(text, 'heading')
+            self.in_title = block.tag == 'h2' and text.strip() == 'Title'
+        else:
+            if self.in_title and self.title is None:
+                self.title = ' '.join(text.split())
+            self.in_title = False
+            self.add(text, 'text')
+            for option in syntab_options(block):
+                self.scores[option] += weights['option']
+
+        for element in block.iter():
+            link_id = element.get('id') if isinstance(element.tag, str) else None
+            if link_id:
+                self.add(link_id, 'marker')
+
+    def add(self, text, kind):
+        weight = weights[kind]
+        for term in term_regex.findall(text.lower()):
+            if term not in stop_words and not term.isdigit():
+                self.scores[term] += weight
+
+    def finish(self, div):
+        pass
+
+    def export(self):
+        return self.title, dict(self.scores)
+
+def element_text(element):
+    parts = []
+    collect_text(element, parts)
+    return ''.join(parts)
+
+def collect_text(element, parts):
+    if not isinstance(element.tag, str): # Entities, such as &#8212;
+        parts.append(html.unescape(element.text))
+        return
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        collect_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+    if element.tag in spaced_tags:
+        parts.append(' ')
+
+def syntab_options(block):
+    """Names of the options in the rows of the syntax tables of a block (such as "vce")"""
+    for table in syntab_tables(block):
+        for section, cells in syntab_rows(table):
+            m = option_regex.match(element_text(cells[1]).strip().lower())
+            if m:
+                yield m.group()
+
+def syntab_tables(block):
+    """Syntax tables of a block (see smcl_parser.parse_syntab)"""
+    for table in block.iter():
+        if table.tag == 'table' and table.get('class') == 'syntab':
+            yield table
+
+def syntab_rows(table):
+    """(section, cells) of the option rows of a syntax table; the section is the text of the last {syntab}"""
+    section = None
+    for tbody in table:
+        if tbody.tag != 'tbody':
+            continue
+        for tr in tbody:
+            cells = list(tr)
+            if tr.get('class') == 'section':
+                section = ' '.join(element_text(tr).split())
+            elif len(cells) >= 2:
+                yield section, cells
+
+# -------------------------------------------------------------
+# Index
+# -------------------------------------------------------------
+
+class SearchIndex(object):
+    """Sharded inverted index of the pages of an output folder, updated a page at a time"""
+
+    def __init__(self, path):
+        self.path = path
+        state = load_json(os.path.join(path, state_name), None)
+        self.fresh = state is None # Files left without a state are replaced
+        self.docs = [] if self.fresh else load_json(os.path.join(path, 'docs.json'), [])
+        self.pages = {} if self.fresh else state['pages'] # page -> {'id': document id, 'shards': [...]}
+        self.removed = collections.defaultdict(set) # shard -> ids to remove
+        self.added = collections.defaultdict(dict) # shard -> {term: [[id, score]]}
+
+    def exists(self):
+        return not self.fresh
+
+    def update(self, page, title, scores):
+        """Replace the terms of a page (given by Terms.export)"""
+        doc_id = self.remove(page)
+        if doc_id is None:
+            doc_id = self.docs.index(None) if None in self.docs else len(self.docs)
+            if doc_id == len(self.docs):
+                self.docs.append(None)
+        self.docs[doc_id] = [page, title or os.path.splitext(page)[0]]
+
+        shards = set()
+        for term, score in scores.items():
+            shard = shard_name(term)
+            shards.add(shard)
+            self.added[shard].setdefault(term, []).append([doc_id, score])
+        self.pages[page] = {'id': doc_id, 'shards': sorted(shards)}
+
+    def remove(self, page):
+        """Remove a page, returning its document id (or None), which is kept until save()"""
+        entry = self.pages.pop(page, None)
+        if entry is None:
+            return None
+        for shard in entry['shards']:
+            self.removed[shard].add(entry['id'])
+        self.docs[entry['id']] = None
+        return entry['id']
+
+    def save(self):
+        """Rewrite the shards that changed and the list of documents, returning how many shards changed"""
+        os.makedirs(self.path, exist_ok=True)
+        if self.fresh:
+            for fn in glob.glob(os.path.join(self.path, 'terms-*.json')):
+                os.remove(fn)
+            self.fresh = False
+        for shard in set(self.removed) | set(self.added):
+            fn = os.path.join(self.path, 'terms-{}.json'.format(shard))
+            postings = load_json(fn, {})
+            removed = self.removed.get(shard)
+            if removed:
+                postings = {term: [p for p in ps if p[0] not in removed] for (term, ps) in postings.items()}
+            for term, ps in self.added.get(shard, {}).items():
+                postings.setdefault(term, []).extend(ps)
+            postings = {term: sorted(ps, key=lambda p: (-p[1], p[0])) for (term, ps) in postings.items() if ps}
+            if postings:
+                save_json(fn, postings)
+            elif os.path.exists(fn):
+                os.remove(fn)
+        shards = len(set(self.removed) | set(self.added))
+        self.removed.clear()
+        self.added.clear()
+        save_json(os.path.join(self.path, 'docs.json'), self.docs)
+        save_json(os.path.join(self.path, state_name), {'pages': self.pages})
+        return shards
+
+def shard_name(term):
+    return term[:2]
+
+def load_json(fn, default):
+    try:
+        with open(fn, 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json(fn, data):
+    with open(fn + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(data, f, separators=(',', ':'), sort_keys=True)
+    os.replace(fn + '.tmp', fn)
@@ -0,0 +1,283 @@
+"""Render help pages on demand over HTTP (smcl2html.py serve)
+
+A help file is only converted the first time /help/<cmd> is requested;
+rendered pages are kept in an LRU cache keyed by the hash of the source
+(and checked against the hashes of the files it includes), and sent with
+an ETag so browsers can revalidate them with a 304.
+
+The server is a single asyncio loop: conversions run in a pool of worker
+processes, and files are hashed in threads, so the loop never blocks.
+It only reads local files, so it works offline.
+
+Notes:
+ - Help files and includes are looked up in a single index of the given
+   folders (and of their subfolders, as in ado/base), which is refreshed
+   when a command is missing and before each page is served, so files
+   added while the server runs are found
+ - Help links to the commands of the index point to /help/<cmd>, so pages
+   can be browsed offline; other links still point to stata.com
+ - Concurrent requests for the same page share a single conversion
+"""
+
+# -------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------
+import os
+import re
+import sys
+import asyncio
+import hashlib
+import traceback
+import collections
+import urllib.parse
+import concurrent.futures
+
+import smcl2html
+import smcl_parser
+import smcl_adopath
+
+# -------------------------------------------------------------
+# Constants
+# -------------------------------------------------------------
+
+help_regex = re.compile(r'^/help/(?P<cmd>[\w.-]+)$')
+static_regex = re.compile(r'^/help/(?P<folder>css|js)/(?P<fn>[\w.-]+)$')
+
+static_path = os.path.dirname(os.path.abspath(__file__))
+static_types = {'.css': 'text/css', '.js': 'application/javascript'}
+
+reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+# -------------------------------------------------------------
+# Rendering (runs in the worker processes)
+# -------------------------------------------------------------
+
+def render(fn, includes, names):
+    """Convert a help file, returning its HTML, ETag and includes
+
+    -includes- is the index of the .ihlp files, and -names- the commands with
+    a help file, both sent by the server with each conversion so the workers
+    never use stale ones.
+    """
+    deps = []
+    with smcl_parser.linking_to(ServerLinks(names)):
+        html = smcl2html.convert(fn, standalone=True, adopath=includes, deps=deps)
+    etag = '"{}"'.format(hashlib.sha1(html).hexdigest())
+    return html, etag, sorted(set(deps))
+
+class ServerLinks(smcl_parser.Links):
+    """Help links to the pages of the server, for the commands in -names-
+
+    Markers are only known once a page is converted, so anchors are kept.
+    """
+
+    def __init__(self, names):
+        super().__init__({})
+        self.names = names
+
+    def resolve(self, link, current_file):
+        name, anchor = smcl_parser.help_target(link, current_file)
+        self.targets.add(name)
+        if name not in self.names:
+            self.unresolved.append(link)
+            return None
+        if name == current_file and anchor:
+            return '#' + anchor
+        return '/help/' + name + ('#' + anchor if anchor else '')
+
+def hash_files(fns):
+    return tuple(smcl2html.file_hash(fn) if os.path.exists(fn) else None for fn in fns)
+
+# -------------------------------------------------------------
+# Server
+# -------------------------------------------------------------
+
+Page = collections.namedtuple('Page', 'html etag includes hashes')
+
+class PageCache(object):
+    """LRU cache of rendered pages, keyed by path and hash of the source, and by the commands linked to"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        page = self.entries.get(key)
+        if page is not None:
+            self.entries.move_to_end(key)
+        return page
+
+    def add(self, key, page):
+        self.entries[key] = page
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+class HelpServer(object):
+
+    def __init__(self, index, pool, cache_size=256):
+        self.index = index
+        self.includes = index.subset(('.ihlp',)) # Smaller, as it's sent with each conversion
+        self.names = help_names(index)
+        self.pool = pool
+        self.cache = PageCache(cache_size)
+        self.rendering = {} # key -> future of a conversion in progress
+        self.refreshing = asyncio.Lock()
+
+    async def find(self, cmd):
+        """Path of the help file of a command, or None"""
+        fn = self.index.find(cmd)
+        if fn is None:
+            # The file may have been added since the index was built
+            await self.refresh()
+            fn = self.index.find(cmd)
+        return fn
+
+    async def refresh(self):
+        async with self.refreshing:
+            await asyncio.get_running_loop().run_in_executor(None, self.refresh_index)
+
+    def refresh_index(self):
+        self.index.refresh()
+        self.includes = self.index.subset(('.ihlp',))
+        names = help_names(self.index)
+        if names != self.names:
+            self.names = names # Pages linking to a command added or removed are converted again
+
+    async def page(self, fn):
+        loop = asyncio.get_running_loop()
+        await self.refresh() # Includes and pages linked to may have been added
+        source_hash, = await loop.run_in_executor(None, hash_files, (fn,))
+        key = (fn, source_hash, self.names)
+
+        page = self.cache.get(key)
+        if page is not None and await loop.run_in_executor(None, hash_files, page.includes) == page.hashes:
+            return page
+
+        # Only one conversion per page at a time
+        future = self.rendering.get(key)
+        if future is None:
+            future = self.rendering[key] = asyncio.ensure_future(self.render(key))
+            future.add_done_callback(lambda _: self.rendering.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def render(self, key):
+        loop = asyncio.get_running_loop()
+        fn, _, names = key
+        html, etag, includes = await loop.run_in_executor(self.pool, render, fn, self.includes, names)
+        hashes = await loop.run_in_executor(None, hash_files, includes)
+        page = Page(html, etag, includes, hashes)
+        self.cache.add(key, page)
+        return page
+
+    async def handle(self, reader, writer):
+        try:
+            status, headers, body = await self.respond(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        lines = ['HTTP/1.1 {} {}'.format(status, reasons[status]), 'Connection: close']
+        lines += ['{}: {}'.format(k, v) for (k, v) in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body:
+            writer.write(body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def respond(self, reader):
+        """Return the status, headers and body of the response to a request"""
+        request_line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+        request_headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            k, _, v = line.partition(':')
+            request_headers[k.strip().lower()] = v.strip()
+
+        parts = request_line.split()
+        if len(parts) != 3:
+            return error(400)
+        method, target, _ = parts
+        if method not in ('GET', 'HEAD'):
+            return error(405, {'Allow': 'GET, HEAD'})
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+
+        m = help_regex.match(path)
+        if m:
+            fn = await self.find(m.group('cmd'))
+            if fn is None:
+                status, headers, body = error(404)
+            else:
+                status, headers, body = await self.help_page(fn, request_headers)
+        else:
+            m = static_regex.match(path)
+            status, headers, body = static_file(m.group('folder'), m.group('fn')) if m else error(404)
+
+        print('{} {} {}'.format(method, path, status))
+        if method == 'HEAD':
+            body = b''
+        return status, headers, body
+
+    async def help_page(self, fn, request_headers):
+        try:
+            page = await self.page(fn)
+        except Exception:
+            traceback.print_exc()
+            return error(500)
+        headers = {'ETag': page.etag, 'Cache-Control': 'no-cache'}
+        if_none_match = [etag.strip() for etag in request_headers.get('if-none-match', '').split(',')]
+        if page.etag in if_none_match or '*' in if_none_match:
+            return 304, headers, b''
+        headers['Content-Type'] = 'text/html; charset=utf-8'
+        headers['Content-Length'] = str(len(page.html))
+        return 200, headers, page.html
+
+def help_names(index):
+    """Commands with a help file in -index-"""
+    return frozenset(name for (name, ext) in index.entries if ext in smcl_adopath.help_extensions)
+
+def static_file(folder, fn):
+    """CSS and scripts linked from the pages"""
+    try:
+        with open(os.path.join(static_path, folder, fn), 'rb') as f:
+            body = f.read()
+    except OSError:
+        return error(404)
+    content_type = static_types.get(os.path.splitext(fn)[-1], 'application/octet-stream')
+    return 200, {'Content-Type': content_type, 'Content-Length': str(len(body))}, body
+
+def error(status, headers=None):
+    body = '{} {}\n'.format(status, reasons[status]).encode('utf8')
+    headers = dict(headers or {}, **{'Content-Type': 'text/plain; charset=utf-8', 'Content-Length': str(len(body))})
+    return status, headers, body
+
+def serve(paths, host='127.0.0.1', port=8000, jobs=None, cache_size=256, index_db=None):
+    """Serve /help/<cmd> for the help files in -paths- until interrupted
+
+    -paths- can be adopaths (folders separated by os.pathsep), and the
+    first ones have precedence. With -index_db-, the index of the folders
+    is kept in that SQLite file.
+    """
+    index = smcl_adopath.AdoIndex([folder for path in paths for folder in smcl_adopath.split_adopath(path)],
+                                  db_fn=index_db)
+    for path in index.missing():
+        print('[Warning] Folder does not exist:', path)
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=smcl2html.init_worker,
+                                                initargs=smcl2html.worker_state()) as pool:
+        server = HelpServer(index, pool, cache_size)
+
+        async def main():
+            tcp_server = await asyncio.start_server(server.handle, host, port)
+            print('Serving help pages at http://{}:{}/help/<command>'.format(host, port))
+            async with tcp_server:
+                await tcp_server.serve_forever()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            print('Stopped', file=sys.stderr)
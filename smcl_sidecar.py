@@ -0,0 +1,113 @@
+"""Structured JSON of a help page, written next to its HTML (see --emit-json)
+
+Sidecar collects the blocks of a page as they are converted, so tools that
+need the options of a command don't have to parse the HTML again:
+
+    {"name": "regress",
+     "title": "[R] regress -- Linear regression",
+     "metadata": {"version": "1.4.4  05mar2015"},      # {* *! ...} comments
+     "jump_to": [{"text": "Syntax", "href": "#syntax"}, ...],
+     "also_see": [{"text": "[R] regress postestimation", "href": "..."}, ...],
+     "syntax_tables": [
+        {"columns": ["Options", "Description"],
+         "options": [{"section": "Reporting", "syntax": "level(#)", "name": "level",
+                      "abbreviation": "l", "arguments": ["#"], "flag": null,
+                      "description": "set confidence level; default is level(95)"}, ...]},
+        ...]}
+
+The abbreviation is the underlined part of the name (null if it can't be
+abbreviated), and the flag is the character before some options, such as
+"*" (see {p2coldent}).
+"""
+
+# -------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------
+import json
+
+from smcl_search import element_text, syntab_tables, syntab_rows, option_regex
+
+# -------------------------------------------------------------
+# Sidecar
+# -------------------------------------------------------------
+
+class Sidecar(object):
+    """Title, metadata, links and syntax tables of a page"""
+
+    def __init__(self, name):
+        self.name = name
+        self.title = None
+        self.in_title = False
+        self.metadata = {}
+        self.jump_to = []
+        self.also_see = []
+        self.syntax_tables = []
+
+    def add_block(self, block):
+        if not isinstance(block.tag, str):
+            return
+        if block.tag == 'nav':
+            links = self.jump_to if block.get('id') == 'table-of-contents' else self.also_see
+            links.extend(nav_links(block))
+            return
+
+        if block.tag in ('h2', 'h3'):
+            self.in_title = block.tag == 'h2' and element_text(block).strip() == 'Title'
+            return
+        if self.in_title and self.title is None:
+            self.title = normalize(element_text(block))
+        self.in_title = False
+
+        for table in syntab_tables(block):
+            self.syntax_tables.append(syntax_table(table))
+
+    def finish(self, div):
+        """Add the metadata of the {* *! ...} comments, stored in the <div> of the page"""
+        self.metadata = {k: v for (k, v) in div.attrib.items() if k != 'class'}
+
+    def export(self):
+        return {'name': self.name, 'title': self.title, 'metadata': self.metadata,
+                'jump_to': self.jump_to, 'also_see': self.also_see, 'syntax_tables': self.syntax_tables}
+
+    def write(self, fn):
+        with open(fn, 'w', encoding='utf8') as f:
+            json.dump(self.export(), f, indent=1, ensure_ascii=False)
+
+def nav_links(nav):
+    for li in nav.iter():
+        if li.tag == 'li' and li.get('class') == 'link':
+            for a in li:
+                if a.tag == 'a':
+                    yield {'text': normalize(element_text(a)), 'href': a.get('href')}
+
+def syntax_table(table):
+    columns = []
+    for thead in table:
+        if thead.tag == 'thead':
+            columns = [normalize(element_text(td)) for tr in thead for td in tr]
+    return {'columns': columns, 'options': [option_record(section, cells) for (section, cells) in syntab_rows(table)]}
+
+def option_record(section, cells):
+    """Option of a row of a syntax table: [flag,] syntax, description"""
+    flag, option, description = ([None] + cells)[-3:]
+    syntax = normalize(element_text(option))
+    m = option_regex.match(syntax.lower())
+
+    # The abbreviation is underlined, and the arguments are in italics, as in lev(#)
+    abbreviation = None
+    arguments = []
+    for element in option.iter():
+        if element.tag == 'u' and abbreviation is None:
+            abbreviation = normalize(element_text(element))
+        elif element.tag == 'var':
+            arguments.append(normalize(element_text(element)))
+    if arguments and syntax.startswith(arguments[0]) and not syntax[len(arguments[0]):].startswith('('):
+        arguments.pop(0) # Options named by a placeholder, such as display_options
+
+    flag = normalize(element_text(flag)) if flag is not None else ''
+    return {'section': section, 'syntax': syntax, 'name': m.group() if m else None,
+            'abbreviation': abbreviation, 'arguments': arguments, 'flag': flag or None,
+            'description': normalize(element_text(description))}
+
+def normalize(text):
+    return ' '.join(text.split())